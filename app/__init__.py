@@ -257,6 +257,10 @@ def create_app(config_name=None):
     from app.error_handlers import register_error_handlers
     register_error_handlers(app)
     
+    # Compile Jinja templates at startup instead of on each worker's first request
+    if not app.config.get('DEBUG', False) and not app.config.get('TESTING', False):
+        _precompile_templates(app)
+    
     # Initialize scheduler if enabled
     if app.config.get('SCHEDULER_ENABLED', True):
         from app.utils.scheduler_init import init_scheduler
@@ -306,3 +310,27 @@ def create_app(config_name=None):
         print('(Save this password - it will not be shown again)')
     
     return app
+
+
+def _precompile_templates(app):
+    """
+    Compile every template (app + blueprints) to Python modules under
+    instance/jinja_cache and serve them through a ModuleLoader ahead of the
+    normal loader, so no request pays for parsing or code generation.
+    Recompiled on every startup, so a deploy never serves stale templates;
+    auto_reload is off since sources don't change while running.
+    """
+    from jinja2 import ChoiceLoader, ModuleLoader
+    
+    target = os.path.join(app.instance_path, 'jinja_cache')
+    try:
+        os.makedirs(target, exist_ok=True)
+        app.jinja_env.compile_templates(target, zip=None, ignore_errors=False)
+    except Exception as e:
+        # Fall back to lazy compilation rather than failing startup
+        app.logger.warning(f'Template precompilation skipped: {e}')
+        return
+    
+    app.jinja_env.auto_reload = False
+    app.jinja_env.loader = ChoiceLoader([ModuleLoader(target), app.jinja_env.loader])
+    app.logger.info(f'Jinja templates precompiled to {target}')
@@ -3,7 +3,11 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_required, current_user
 from app.extensions import db
 from datetime import datetime, date, timedelta
-import json
+try:
+    # C parser for the per-medication custom_reminder_times blobs parsed on every dashboard render
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Import User inside functions to avoid circular imports
 def get_user_model():
@@ -25,6 +29,7 @@ def dashboard():
         from app.models.medication import Medication
         from app.models.medication_log import MedicationLog
         from app.models.snooze_log import SnoozeLog
+        from sqlalchemy import func
         
         # Get all medications for the user
         medications = Medication.query.filter_by(user_id=current_user.id).all()
@@ -39,6 +44,11 @@ def dashboard():
             MedicationLog.taken_at >= today_start,
             MedicationLog.taken_at <= today_end
         ).all()
+        
+        # Group today's logs by medication once, instead of rescanning them per medication
+        logs_by_med = {}
+        for log in today_logs:
+            logs_by_med.setdefault(log.medication_id, []).append(log)
             
         # Check for active snooze
         now = datetime.now()  # Use local time consistently
@@ -48,19 +58,24 @@ def dashboard():
         ).order_by(SnoozeLog.created_at.desc()).first()
             
         # Calculate statistics
-        upcoming_count = len([m for m in medications if any([m.morning, m.afternoon, m.evening, m.night, m.custom_reminder_times])])
+        upcoming_count = sum(1 for m in medications if m.morning or m.afternoon or m.evening or m.night or m.custom_reminder_times)
         today_count = len(medications)
             
         # Calculate compliance
-        total_logs = MedicationLog.query.filter_by(user_id=current_user.id).all()
-        taken_logs = [log for log in total_logs if log.taken_correctly]
-        compliance_rate = int((len(taken_logs) / len(total_logs) * 100)) if total_logs else 0
+        # Counted in SQL: at most one row per taken_correctly value instead of every log
+        log_counts = dict(db.session.query(
+            MedicationLog.taken_correctly, func.count()
+        ).filter(MedicationLog.user_id == current_user.id).group_by(MedicationLog.taken_correctly).all())
+        total_logs_count = sum(log_counts.values())
+        taken_count = log_counts.get(True, 0)
+        missed_count = total_logs_count - taken_count
+        compliance_rate = int((taken_count / total_logs_count * 100)) if total_logs_count else 0
             
         # Get today's medications with status
         today_medications = []
         for med in medications:
             # Get logs for this medication today
-            med_logs = [log for log in today_logs if log.medication_id == med.id]
+            med_logs = logs_by_med.get(med.id, [])
                 
             # Parse scheduled times for display with individual taken status
             scheduled_times = []
@@ -68,7 +83,7 @@ def dashboard():
             
             if med.custom_reminder_times:
                 try:
-                    custom_times = json.loads(med.custom_reminder_times)
+                    custom_times = json_loads(med.custom_reminder_times)
                     for t in custom_times:
                         # Parse the time string to create a datetime for comparison
                         try:
@@ -145,7 +160,7 @@ def dashboard():
             # Check custom reminder times
             if med.custom_reminder_times:
                 try:
-                    custom_times = json.loads(med.custom_reminder_times)
+                    custom_times = json_loads(med.custom_reminder_times)
                     for time_str in custom_times:
                         try:
                             scheduled = datetime.strptime(time_str, "%H:%M").replace(
@@ -225,7 +240,7 @@ def dashboard():
             if next_dose:
                 # Check if this dose has been taken
                 # Get logs for this med today
-                med_logs = [l for l in today_logs if l.medication_id == med.id]
+                med_logs = logs_by_med.get(med.id, [])
                 
                 is_taken = False
                 dose_time = next_dose['time']
@@ -271,10 +286,6 @@ def dashboard():
             if isinstance(med['time'], datetime):
                 med['time'] = format_time_for_display(med['time'])
             
-        # Count taken and missed
-        taken_count = len([log for log in total_logs if log.taken_correctly])
-        missed_count = len([log for log in total_logs if not log.taken_correctly])
-        
         # ======== NEW: Dashboard State Calculation ========
         # Determine if user needs to take medication NOW
         dashboard_state = 'calm'  # Default: no medication due
@@ -288,8 +299,8 @@ def dashboard():
         for med in medications:
             if med.custom_reminder_times:
                 try:
-                    times = json.loads(med.custom_reminder_times)
-                    med_logs = [l for l in today_logs if l.medication_id == med.id]
+                    times = json_loads(med.custom_reminder_times)
+                    med_logs = logs_by_med.get(med.id, [])
                     
                     for time_str in times:
                         try:
@@ -418,14 +429,14 @@ def dashboard():
                 # Count custom times
                 if med.custom_reminder_times:
                     try:
-                        daily_doses += len(json.loads(med.custom_reminder_times))
+                        daily_doses += len(json_loads(med.custom_reminder_times))
                     except:
                         pass
             
-            taken_today_count = len([l for l in today_logs if l.taken_correctly])
+            taken_today_count = sum(1 for l in today_logs if l.taken_correctly)
             
             # Calculate compliance
-            total_taken = len([l for l in logs if l.taken_correctly])
+            total_taken = sum(1 for l in logs if l.taken_correctly)
             compliance = int((total_taken / len(logs) * 100)) if logs else 0
             
             # Last active
@@ -474,7 +485,7 @@ def getNextMedicationTime(med, now):
     # Check custom times first - these should take priority
     if med.custom_reminder_times:
         try:
-            custom_times = json.loads(med.custom_reminder_times)
+            custom_times = json_loads(med.custom_reminder_times)
             for time_str in custom_times:
                 time_parts = time_str.split(':')
                 if len(time_parts) == 2:
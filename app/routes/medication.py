@@ -432,10 +432,11 @@ def verify_realtime():
         
         # Layer 2: ORB Features
         expected_des = None
+        expected_profile = None
         if medication and medication.visual_fingerprint:
             try:
-                des_bytes = base64.b64decode(medication.visual_fingerprint)
-                expected_des = np.frombuffer(des_bytes, np.uint8).reshape(-1, 32)
+                expected_des = vision_v2.decode_orb_fingerprint(medication.visual_fingerprint)
+                expected_profile = vision_v2.orb_fingerprint_profile(medication.visual_fingerprint)
             except Exception as e:
                 logger.error(f"Failed to decode ORB fingerprint: {e}")
         
@@ -464,6 +465,7 @@ def verify_realtime():
         result = vision_v2.process_frame(
             image_data, 
             expected_features=expected_des,
+            expected_profile=expected_profile,
             reference_histogram=reference_histogram,
             reference_embedding=reference_embeddings # Now passing the full list
         )
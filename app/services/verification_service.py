@@ -62,10 +62,11 @@ class VerificationService:
             # ===== TRIPLE-LAYER VERIFICATION ENGINE =====
             # Layer 2: ORB Feature Matching
             expected_des = None
+            expected_profile = None
             if medication.visual_fingerprint:
                 try:
-                    des_bytes = base64.b64decode(medication.visual_fingerprint)
-                    expected_des = np.frombuffer(des_bytes, np.uint8).reshape(-1, 32)
+                    expected_des = self.vision_engine.decode_orb_fingerprint(medication.visual_fingerprint)
+                    expected_profile = self.vision_engine.orb_fingerprint_profile(medication.visual_fingerprint)
                     print(f"[VERIFY] Layer 2 (ORB): Loaded {expected_des.shape[0]} descriptors")
                 except Exception as e:
                     logger.error(f"Failed to decode ORB fingerprint: {e}")
@@ -101,6 +102,7 @@ class VerificationService:
             result = self.vision_engine.process_frame(
                 image_data, 
                 expected_features=expected_des,
+                expected_profile=expected_profile,
                 reference_histogram=reference_histogram,
                 reference_embedding=reference_embedding
             )
@@ -7,48 +7,88 @@ Supports multi-angle reference images for robust matching.
 import numpy as np
 import cv2
 import base64
+import hashlib
 import json
-from typing import List, Optional, Tuple
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
 import torch
 import torchvision.transforms as transforms
-from PIL import Image
-import io
 import logging
 
+# v2 transforms operate on tensors natively (torchvision >= 0.15)
+try:
+    import torchvision.transforms.v2 as transforms_v2
+except ImportError:
+    transforms_v2 = transforms
+
 logger = logging.getLogger(__name__)
 
 
 # Lazy load model to avoid startup delay
 _feature_model = None
 _transform = None
+_model_lock = threading.Lock()
+_device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# Separate CUDA streams so the next frame's host->device copy can overlap
+# the current frame's forward pass (created lazily, CUDA only)
+_copy_stream = None
+_compute_stream = None
+
+
+def _build_transform() -> torch.nn.Module:
+    """
+    Standard ImageNet preprocessing as a tensor pipeline.
+    Runs on the model's device, so no PIL round-trip is needed per frame.
+    """
+    return torch.nn.Sequential(
+        transforms_v2.Resize(256, antialias=True),
+        transforms_v2.CenterCrop(224),
+        transforms_v2.ConvertImageDtype(torch.float32),
+        transforms_v2.Normalize(
+            mean=[0.485, 0.456, 0.406],
+            std=[0.229, 0.224, 0.225]
+        )
+    ).to(_device)
+
+
+def _prepare_model(model: torch.nn.Module) -> torch.nn.Module:
+    """Strip the classifier head, switch to eval and pin the model on the device"""
+    model = torch.nn.Sequential(*list(model.children())[:-1])
+    model.eval()
+    if _device.type == 'cuda':
+        # channels_last lets cuDNN pick the faster NHWC convolution kernels
+        model = model.to(_device, memory_format=torch.channels_last)
+        torch.backends.cudnn.benchmark = True
+    return model
+
 
 def get_feature_model():
     """Get or load the pretrained EfficientNet-B0 model for feature extraction"""
     global _feature_model, _transform
     
-    if _feature_model is None:
+    if _feature_model is not None:
+        return _feature_model, _transform
+    
+    # Double-checked so concurrent real-time threads load the model only once
+    with _model_lock:
+        if _feature_model is not None:
+            return _feature_model, _transform
+        
         try:
             import torchvision.models as models
             
             # Use EfficientNet-B0 - better texture/layout sensitivity than ResNet-18
             # More robust to rotation and lighting while still lightweight
             weights = models.EfficientNet_B0_Weights.IMAGENET1K_V1
-            _feature_model = models.efficientnet_b0(weights=weights)
             
             # Remove the final classification layer to get 1280-dim features
-            _feature_model = torch.nn.Sequential(*list(_feature_model.children())[:-1])
-            _feature_model.eval()
+            model = _prepare_model(models.efficientnet_b0(weights=weights))
             
             # Standard ImageNet preprocessing (EfficientNet uses same as ResNet)
-            _transform = transforms.Compose([
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406],
-                    std=[0.229, 0.224, 0.225]
-                )
-            ])
+            _transform = _build_transform()
+            _feature_model = model
             
             logger.info("✅ Feature extractor (EfficientNet-B0) loaded successfully")
         except Exception as e:
@@ -56,16 +96,10 @@ def get_feature_model():
             try:
                 # Fallback to ResNet-18 if EfficientNet not available
                 import torchvision.models as models
-                _feature_model = models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1)
-                _feature_model = torch.nn.Sequential(*list(_feature_model.children())[:-1])
-                _feature_model.eval()
+                model = _prepare_model(models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1))
                 
-                _transform = transforms.Compose([
-                    transforms.Resize(256),
-                    transforms.CenterCrop(224),
-                    transforms.ToTensor(),
-                    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-                ])
+                _transform = _build_transform()
+                _feature_model = model
                 logger.info("✅ Feature extractor (ResNet-18 fallback) loaded")
             except Exception as e2:
                 logger.error(f"⚠️ Feature extractor failed to load: {e2}")
@@ -138,18 +172,20 @@ def extract_features(image: np.ndarray) -> Optional[np.ndarray]:
         # Step 2: Convert BGR to RGB
         rgb_image = cv2.cvtColor(normalized, cv2.COLOR_BGR2RGB)
         
-        # Step 3: Convert to PIL Image
-        pil_image = Image.fromarray(rgb_image)
-        
-        # Step 4: Apply transforms (resize, normalize for ImageNet)
-        tensor = transform(pil_image).unsqueeze(0)
+        # Step 3: HWC uint8 array -> CHW tensor on the model's device
+        tensor = torch.from_numpy(rgb_image).permute(2, 0, 1).to(_device, non_blocking=True)
         
-        # Step 5: Extract features
         with torch.no_grad():
+            # Step 4: Apply transforms (resize, normalize for ImageNet)
+            tensor = transform(tensor).unsqueeze(0)
+            if _device.type == 'cuda':
+                tensor = tensor.contiguous(memory_format=torch.channels_last)
+            
+            # Step 5: Extract features
             features = model(tensor)
         
         # Flatten and convert to numpy
-        feature_vector = features.flatten().numpy()
+        feature_vector = features.flatten().cpu().numpy()
         
         return feature_vector
         
@@ -158,6 +194,77 @@ def extract_features(image: np.ndarray) -> Optional[np.ndarray]:
         return None
 
 
+def _get_streams():
+    """Get or create the copy/compute CUDA stream pair"""
+    global _copy_stream, _compute_stream
+    if _copy_stream is None:
+        _copy_stream = torch.cuda.Stream()
+        _compute_stream = torch.cuda.Stream()
+    return _copy_stream, _compute_stream
+
+
+def extract_features_async(image: np.ndarray):
+    """
+    Start feature extraction without waiting for the GPU.
+    
+    The frame is staged in pinned memory and copied on a dedicated stream;
+    the forward pass runs on a second stream that waits only on that copy.
+    Pass the returned handle to collect_features() once the result is
+    needed, so the next frame can be prepared in the meantime. On CPU this
+    degrades to a synchronous extract_features() call.
+    
+    Args:
+        image: OpenCV image (BGR format)
+        
+    Returns:
+        Opaque pending handle for collect_features(), or None on failure
+        (on CPU as well, so callers can test the handle itself)
+    """
+    if _device.type != 'cuda':
+        features = extract_features(image)
+        return None if features is None else (features, None)
+    
+    model, transform = get_feature_model()
+    if model is None:
+        return None
+    
+    try:
+        normalized = normalize_lighting(image)
+        rgb_image = cv2.cvtColor(normalized, cv2.COLOR_BGR2RGB)
+        host = torch.from_numpy(rgb_image).permute(2, 0, 1).pin_memory()
+        
+        copy_stream, compute_stream = _get_streams()
+        with torch.cuda.stream(copy_stream):
+            tensor = host.to(_device, non_blocking=True)
+        compute_stream.wait_event(copy_stream.record_event())
+        # Allocated on the copy stream but consumed on the compute stream
+        tensor.record_stream(compute_stream)
+        
+        with torch.cuda.stream(compute_stream), torch.no_grad():
+            batch = transform(tensor).unsqueeze(0).contiguous(memory_format=torch.channels_last)
+            features = model(batch).flatten()
+            done = compute_stream.record_event()
+        
+        return features, done
+        
+    except Exception as e:
+        logger.error(f"Async feature extraction error: {e}")
+        return None
+
+
+def collect_features(pending) -> Optional[np.ndarray]:
+    """Wait for an extract_features_async() handle and return the feature vector"""
+    if pending is None:
+        return None
+    
+    features, done = pending
+    if done is None:
+        return features
+    
+    done.synchronize()
+    return features.cpu().numpy()
+
+
 def extract_features_from_base64(base64_image: str) -> Optional[np.ndarray]:
     """Extract features from a base64 encoded image"""
     try:
@@ -198,9 +305,152 @@ def cosine_similarity(vec1: np.ndarray, vec2: np.ndarray) -> float:
     return float(max(0.0, min(1.0, similarity)))
 
 
+def _stack_bank(features: Sequence[Optional[np.ndarray]]) -> Optional[np.ndarray]:
+    """
+    Stack per-reference features into a (N, D) float16 bank.
+    
+    References whose features could not be extracted become NaN rows, so row i
+    of the bank is always reference angle i.
+    """
+    extracted = [f for f in features if f is not None]
+    if not extracted:
+        return None
+    
+    missing = np.full_like(extracted[0], np.nan, dtype=np.float32)
+    return np.stack([missing if f is None else f for f in features]).astype(np.float16)
+
+
+def build_reference_bank(
+    reference_images_json: str,
+    bank_path: Optional[str] = None
+) -> Optional[np.ndarray]:
+    """
+    Precompute the feature bank for a medication's reference images.
+    
+    Decodes each base64 reference once and stacks the feature vectors into a
+    (N, D) float16 matrix so verification never has to re-parse the JSON or
+    re-run the CNN on the references. Meant to be called at registration time.
+    
+    Args:
+        reference_images_json: JSON array of base64 reference images
+        bank_path: Optional .npy path to persist the bank to
+        
+    Returns:
+        Feature bank array, or None if no reference could be processed
+    """
+    try:
+        reference_images = json.loads(reference_images_json)
+    except (TypeError, ValueError) as e:
+        logger.error(f"Reference bank parse error: {e}")
+        return None
+    
+    features = [extract_features_from_base64(ref_base64) for ref_base64 in reference_images]
+    
+    bank = _stack_bank(features)
+    if bank is None:
+        return None
+    
+    if bank_path:
+        try:
+            np.save(bank_path, bank)
+            logger.info(f"Reference bank saved: {bank_path} {bank.shape}")
+        except OSError as e:
+            logger.warning(f"Could not persist reference bank to {bank_path}: {e}")
+    
+    return bank
+
+
+def build_reference_bank_from_files(
+    reference_paths: Sequence[str],
+    bank_path: Optional[str] = None
+) -> Optional[np.ndarray]:
+    """
+    Same as build_reference_bank, for reference images stored as JPEG files
+    (e.g. reference_{med_id}_{angle}.jpg) instead of base64 JSON.
+    """
+    features = []
+    for path in reference_paths:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            logger.warning(f"Reference image not readable: {path}")
+            features.append(None)
+            continue
+        features.append(extract_features(image))
+    
+    bank = _stack_bank(features)
+    if bank is None:
+        return None
+    
+    if bank_path:
+        try:
+            np.save(bank_path, bank)
+            logger.info(f"Reference bank saved: {bank_path} {bank.shape}")
+        except OSError as e:
+            logger.warning(f"Could not persist reference bank to {bank_path}: {e}")
+    
+    return bank
+
+
+# In-process bank cache keyed by a hash of the reference set, so each
+# unique set of references is decoded and embedded exactly once
+_REFERENCE_BANK_CACHE_SIZE = 128
+_reference_bank_cache: Dict[str, np.ndarray] = {}
+_reference_bank_lock = threading.Lock()
+
+
+def _reference_key(references) -> str:
+    """Content hash for a JSON reference set, or path+mtime hash for files"""
+    digest = hashlib.sha1()
+    if isinstance(references, str):
+        digest.update(references.encode('utf-8'))
+    else:
+        for path in references:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                mtime = 0
+            digest.update(f"{path}:{mtime}".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_reference_bank(references) -> Optional[np.ndarray]:
+    """
+    Get the feature bank for a reference set, building it on first use.
+    
+    Args:
+        references: JSON array of base64 images, or a list of JPEG file paths
+    """
+    key = _reference_key(references)
+    bank = _reference_bank_cache.get(key)
+    if bank is not None:
+        return bank
+    
+    if isinstance(references, str):
+        bank = build_reference_bank(references)
+    else:
+        bank = build_reference_bank_from_files(references)
+    
+    if bank is not None:
+        with _reference_bank_lock:
+            if len(_reference_bank_cache) >= _REFERENCE_BANK_CACHE_SIZE:
+                _reference_bank_cache.pop(next(iter(_reference_bank_cache)))
+            _reference_bank_cache[key] = bank
+    
+    return bank
+
+
+def load_reference_bank(bank_path: str) -> Optional[np.ndarray]:
+    """Memory-map a persisted reference bank (shared via the OS page cache)"""
+    try:
+        return np.load(bank_path, mmap_mode='r')
+    except (OSError, ValueError) as e:
+        logger.error(f"Reference bank load error: {e}")
+        return None
+
+
 def compare_to_references(
     live_image: np.ndarray,
-    reference_images_json: str,
+    reference_images_json,
     background_image_base64: Optional[str] = None
 ) -> Tuple[float, int]:
     """
@@ -209,17 +459,24 @@ def compare_to_references(
     
     Args:
         live_image: Current camera frame (OpenCV BGR)
-        reference_images_json: JSON array of base64 reference images
+        reference_images_json: JSON array of base64 reference images, a list
+            of reference JPEG paths, a precomputed feature bank (see
+            build_reference_bank), or a path to a persisted .npy bank
         background_image_base64: Optional background-only image for subtraction
         
     Returns:
         Tuple of (best_similarity_score, best_angle_index)
     """
     try:
-        # Parse reference images
-        reference_images = json.loads(reference_images_json)
+        # Resolve the reference feature bank
+        if isinstance(reference_images_json, np.ndarray):
+            bank = reference_images_json
+        elif isinstance(reference_images_json, str) and reference_images_json.endswith('.npy'):
+            bank = load_reference_bank(reference_images_json)
+        else:
+            bank = get_reference_bank(reference_images_json)
         
-        if not reference_images:
+        if bank is None or len(bank) == 0:
             return 0.0, -1
         
         # Extract features from live image
@@ -234,26 +491,25 @@ def compare_to_references(
             if background_features is not None:
                 logger.info("🔍 Using background subtraction for comparison")
         
-        best_score = 0.0
-        best_index = -1
-        
-        # Compare to each reference angle
-        for i, ref_base64 in enumerate(reference_images):
-            ref_features = extract_features_from_base64(ref_base64)
-            if ref_features is not None:
-                if background_features is not None:
-                    # Subtract background from both live and reference
-                    # This emphasizes the differences (the medication)
-                    live_diff = live_features - background_features
-                    ref_diff = ref_features - background_features
-                    score = cosine_similarity(live_diff, ref_diff)
-                else:
-                    # Traditional direct comparison
-                    score = cosine_similarity(live_features, ref_features)
-                    
-                if score > best_score:
-                    best_score = score
-                    best_index = i
+        refs = np.asarray(bank, dtype=np.float32)
+        live = live_features.astype(np.float32)
+        if background_features is not None:
+            # Subtract background from both live and reference
+            # This emphasizes the differences (the medication)
+            refs = refs - background_features
+            live = live - background_features
+        
+        # Cosine similarity against every reference angle in one pass
+        ref_norms = np.linalg.norm(refs, axis=1) + 1e-8
+        live_norm = np.linalg.norm(live) + 1e-8
+        scores = np.clip((refs @ live) / (ref_norms * live_norm), 0.0, 1.0)
+        # NaN rows are references that failed to extract; they never match
+        scores = np.nan_to_num(scores, nan=0.0)
+        
+        best_index = int(np.argmax(scores))
+        best_score = float(scores[best_index])
+        if best_score <= 0.0:
+            best_score, best_index = 0.0, -1
         
         logger.info(f"Visual similarity: best={best_score:.2%} from angle {best_index}{' (bg-subtracted)' if background_features is not None else ''}")
         return best_score, best_index
@@ -9,11 +9,32 @@ except ImportError:
     print("[Vision] WARNING: PyTorch not available - Vision features will be disabled")
 
 import logging
+import os
+import sys
 from typing import Optional
 from threading import Lock
 
 logger = logging.getLogger(__name__)
 
+# Largest batch a TensorRT engine is built for (dynamic batch axis up to this)
+TRT_MAX_BATCH = 8
+
+# Frames used to calibrate INT8 engines (backend='trt-int8'); without them the
+# FP16 engine is used instead
+CALIBRATION_DIR = os.getenv('YOLO_CALIBRATION_DIR', 'data/calibration')
+CALIBRATION_IMAGES = 200
+CALIBRATION_BATCH = 8
+
+
+def _artifact_path(model_path: str, imgsz: int, suffix: str) -> str:
+    """
+    Path for an export of model_path, named after the input it accepts
+    (dynamic batch 1..TRT_MAX_BATCH at imgsz x imgsz) so it never collides
+    with static exports of the same weights, e.g. pill_detection's
+    yolov5s_b1_640.engine.
+    """
+    return f"{os.path.splitext(model_path)[0]}_b1-{TRT_MAX_BATCH}_{imgsz}{suffix}"
+
 
 class ModelManager:
     """Singleton manager for AI models to prevent redundant loading"""
@@ -30,12 +51,22 @@ class ModelManager:
         return cls._instance
     
     def __init__(self):
-        """Initialize model manager (only once)"""
+        """
+        Initialize model manager (only once)
+        
+        Thread budget for real-time vision (see configure_thread_budget):
+        OpenCV gets 2 worker threads for capture/colour conversion/resize,
+        PyTorch intra-op gets the remaining cores minus 3, leaving one core
+        each for the capture loop, the detection thread and result I/O.
+        """
         if self._initialized:
             return
         
         self._yolo_model = None
         self._yolo_model_path = None
+        self._yolo_backend = None
+        self._yolo_imgsz = None
+        self._load_lock = Lock()  # serializes loading so concurrent callers share one load + warmup
         self._tesseract_available = False
         self._initialized = True
         
@@ -48,31 +79,66 @@ class ModelManager:
         except Exception as e:
             logger.warning(f"Tesseract OCR not available: {e}")
     
-    def get_yolo_model(self, model_path: str = 'yolov5s.pt', force_reload: bool = False):
+    def get_yolo_model(self, model_path: str = 'yolov5s.pt', force_reload: bool = False,
+                       backend: str = 'torch', imgsz: int = 640):
         """
         Get YOLO model (loads once, cached thereafter)
         
         Args:
             model_path: Path to YOLO model weights
             force_reload: Force reload even if already cached
+            backend: 'torch' for the PyTorch hub model, 'trt' for an FP16
+                     TensorRT engine built from model_path (CUDA only; falls
+                     back to 'torch' if the engine can't be built), 'trt-int8'
+                     for an INT8 engine calibrated on CALIBRATION_DIR (falls
+                     back to the FP16 engine without calibration frames)
+            imgsz: Inference size the model is specialized for
             
         Returns:
             Loaded YOLO model
         """
-        # Return cached model if available and path matches
-        if not force_reload and self._yolo_model is not None:
-            if self._yolo_model_path == model_path:
-                logger.debug("Using cached YOLO model")
-                return self._yolo_model
+        # Return cached model if available and path/backend/size match
+        if self._is_cached(model_path, backend, imgsz, force_reload):
+            logger.debug("Using cached YOLO model")
+            return self._yolo_model
         
-        # Load model
+        with self._load_lock:
+            # Another thread may have finished loading while we waited
+            if self._is_cached(model_path, backend, imgsz, force_reload):
+                return self._yolo_model
+            return self._load_yolo_model(model_path, backend, imgsz)
+    
+    def _is_cached(self, model_path: str, backend: str, imgsz: int, force_reload: bool) -> bool:
+        return (not force_reload and self._yolo_model is not None and
+                self._yolo_model_path == model_path and self._yolo_backend == backend and
+                self._yolo_imgsz == imgsz)
+    
+    def _load_yolo_model(self, model_path: str, backend: str, imgsz: int):
+        """Load, compile and warm up the YOLO model (called with _load_lock held)"""
         try:
             if torch is None:
                 raise ImportError("PyTorch not available")
-                
-            logger.info(f"Loading YOLO model from {model_path}...")
-            self._yolo_model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+            
+            engine_path = None
+            if backend == 'trt-int8' and torch.cuda.is_available():
+                engine_path = self._build_int8_engine(model_path, imgsz)
+            if backend in ('trt', 'trt-int8') and torch.cuda.is_available() and not engine_path:
+                engine_path = self._build_trt_engine(model_path, imgsz)
+            
+            if engine_path:
+                # The hub loader runs .engine files behind the same AutoShape API
+                logger.info(f"Loading TensorRT engine from {engine_path}...")
+                self._yolo_model = torch.hub.load('ultralytics/yolov5', 'custom', path=engine_path)
+            else:
+                logger.info(f"Loading YOLO model from {model_path}...")
+                self._yolo_model = torch.hub.load('ultralytics/yolov5', 'yolov5s', pretrained=True)
+                # Inference only: fix dropout/BatchNorm in eval behaviour before compiling
+                self._yolo_model.model.eval()
+                self._compile_yolo_model(self._yolo_model, imgsz)
+            self._warmup_yolo_model(self._yolo_model, imgsz)
             self._yolo_model_path = model_path
+            self._yolo_backend = backend
+            self._yolo_imgsz = imgsz
             logger.info("[Vision] YOLO model loaded successfully (cached for future use)")
             return self._yolo_model
             
@@ -80,7 +146,210 @@ class ModelManager:
             logger.error(f"Failed to load YOLO model: {e}")
             self._yolo_model = None
             self._yolo_model_path = None
+            self._yolo_backend = None
+            self._yolo_imgsz = None
+            return None
+    
+    def _build_trt_engine(self, model_path: str, imgsz: int) -> Optional[str]:
+        """
+        Build an FP16 TensorRT engine for model_path with a dynamic batch
+        axis (1..TRT_MAX_BATCH). The engine is written next to the weights
+        as <name>_b1-<TRT_MAX_BATCH>_<imgsz>_fp16.engine and reused on later
+        loads if its input profile still matches.
+        
+        The hub exporter refuses half=True together with dynamic=True, so the
+        model is exported to dynamic ONNX and the engine is built with the
+        TensorRT builder API (see _build_engine_from_onnx).
+        
+        Returns:
+            Engine path, or None if TensorRT/export is unavailable
+        """
+        engine_path = _artifact_path(model_path, imgsz, '_fp16.engine')
+        try:
+            import tensorrt as trt
+            
+            if _engine_matches(trt, engine_path, imgsz):
+                return engine_path
+            onnx_path = self._export_dynamic_onnx(model_path, imgsz)
+            logger.info(f"Building FP16 TensorRT engine for {model_path}...")
+            return self._build_engine_from_onnx(trt, onnx_path, engine_path, imgsz)
+        except Exception as e:
+            logger.warning(f"TensorRT engine unavailable for {model_path}, using PyTorch: {e}")
+            return None
+    
+    def _build_int8_engine(self, model_path: str, imgsz: int) -> Optional[str]:
+        """
+        Build an INT8 (with FP16 fallback layers) TensorRT engine for
+        model_path, calibrated with entropy calibration on up to
+        CALIBRATION_IMAGES frames from CALIBRATION_DIR.
+        
+        The hub exporter has no INT8 mode, so like the FP16 engine it is
+        built from the dynamic ONNX export with the TensorRT builder API.
+        The engine is written next to the weights as
+        <name>_b1-<TRT_MAX_BATCH>_<imgsz>_int8.engine and the calibration
+        table alongside it, so later builds skip calibration.
+        
+        Returns:
+            Engine path, or None if there are no calibration frames or
+            TensorRT/export is unavailable
+        """
+        engine_path = _artifact_path(model_path, imgsz, '_int8.engine')
+        try:
+            import tensorrt as trt
+        except ImportError as e:
+            logger.warning(f"INT8 TensorRT engine unavailable for {model_path}, trying FP16: {e}")
             return None
+        if _engine_matches(trt, engine_path, imgsz):
+            return engine_path
+        
+        image_exts = ('.jpg', '.jpeg', '.png', '.bmp')
+        images = []
+        if os.path.isdir(CALIBRATION_DIR):
+            images = sorted(os.path.join(CALIBRATION_DIR, f) for f in os.listdir(CALIBRATION_DIR)
+                            if f.lower().endswith(image_exts))[:CALIBRATION_IMAGES]
+        cache_path = _artifact_path(model_path, imgsz, '_int8.calib')
+        if not images and not os.path.exists(cache_path):
+            logger.warning(f"No INT8 calibration frames in {CALIBRATION_DIR}, using FP16 engine")
+            return None
+        
+        try:
+            onnx_path = self._export_dynamic_onnx(model_path, imgsz)
+            logger.info(f"Building INT8 TensorRT engine for {model_path} ({len(images)} calibration frames)...")
+            return self._build_engine_from_onnx(
+                trt, onnx_path, engine_path, imgsz,
+                calibrator=_make_int8_calibrator(trt, images, imgsz, cache_path))
+        except Exception as e:
+            logger.warning(f"INT8 TensorRT engine unavailable for {model_path}, trying FP16: {e}")
+            return None
+    
+    @staticmethod
+    def _export_dynamic_onnx(model_path: str, imgsz: int) -> str:
+        """
+        Export model_path to ONNX with a dynamic batch axis at imgsz (reused
+        if present). The exporter always writes <name>.onnx, which static
+        exports share, so the result is moved to its shape-specific name.
+        """
+        onnx_path = _artifact_path(model_path, imgsz, '.onnx')
+        if not os.path.exists(onnx_path):
+            repo_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+            if repo_dir not in sys.path:
+                sys.path.insert(0, repo_dir)
+            import export as yolov5_export
+            
+            yolov5_export.run(weights=model_path, include=('onnx',), imgsz=(imgsz, imgsz),
+                              dynamic=True, device='cpu')
+            os.replace(os.path.splitext(model_path)[0] + '.onnx', onnx_path)
+        return onnx_path
+    
+    @staticmethod
+    def _build_engine_from_onnx(trt, onnx_path: str, engine_path: str, imgsz: int,
+                                calibrator=None) -> str:
+        """
+        Build and save an FP16 TensorRT engine from onnx_path, accepting any
+        batch size from 1 to TRT_MAX_BATCH at imgsz x imgsz. With a calibrator,
+        INT8 is enabled as well (FP16 covers layers without INT8 kernels).
+        """
+        trt_logger = trt.Logger(trt.Logger.WARNING)
+        builder = trt.Builder(trt_logger)
+        network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, trt_logger)
+        with open(onnx_path, 'rb') as f:
+            if not parser.parse(f.read()):
+                raise RuntimeError(f"failed to parse {onnx_path}: {parser.get_error(0)}")
+        
+        config = builder.create_builder_config()
+        config.set_flag(trt.BuilderFlag.FP16)
+        
+        input_name = network.get_input(0).name
+        profile = builder.create_optimization_profile()
+        profile.set_shape(input_name, (1, 3, imgsz, imgsz),
+                          (max(1, TRT_MAX_BATCH // 2), 3, imgsz, imgsz),
+                          (TRT_MAX_BATCH, 3, imgsz, imgsz))
+        config.add_optimization_profile(profile)
+        
+        if calibrator is not None:
+            config.set_flag(trt.BuilderFlag.INT8)
+            config.int8_calibrator = calibrator
+            # TensorRT calibrates at the profile's OPT shape, so give it a
+            # profile pinned to the calibrator's batch size
+            calib_shape = (CALIBRATION_BATCH, 3, imgsz, imgsz)
+            calib_profile = builder.create_optimization_profile()
+            calib_profile.set_shape(input_name, calib_shape, calib_shape, calib_shape)
+            config.set_calibration_profile(calib_profile)
+        
+        serialized = builder.build_serialized_network(network, config)
+        if serialized is None:
+            raise RuntimeError("TensorRT engine build failed")
+        with open(engine_path, 'wb') as f:
+            f.write(serialized)
+        return engine_path
+    
+    def _compile_yolo_model(self, model, imgsz: int = 640):
+        """
+        Specialize the YOLO network for a fixed input shape with torch.compile.
+        
+        The camera resolution is fixed per deployment, so a static-shape graph
+        is compiled once and reused for every frame. Only the inner network is
+        compiled; the hub AutoShape wrapper (numpy pre/post-processing) stays
+        eager. Skipped silently on CPU or torch < 2.0.
+        """
+        if not hasattr(torch, 'compile') or not torch.cuda.is_available():
+            return
+        
+        eager_model = model.model
+        try:
+            device = next(model.parameters()).device
+            model.model = torch.compile(eager_model, mode='reduce-overhead', dynamic=False)
+            
+            # Pre-warm so compilation happens at load time, not on the first frame
+            with torch.inference_mode():
+                model(torch.zeros(1, 3, imgsz, imgsz, device=device))
+            logger.info(f"[Vision] YOLO model compiled for {imgsz}x{imgsz} input on {device}")
+        except Exception as e:
+            model.model = eager_model
+            logger.warning(f"torch.compile unavailable for YOLO model, using eager mode: {e}")
+    
+    def _warmup_yolo_model(self, model, imgsz: int = 640):
+        """
+        Run one dummy forward pass so cuDNN autotuning and lazy kernel
+        initialization happen at load time instead of on the first real frame.
+        
+        cudnn.benchmark is enabled first: inference runs at a fixed input
+        size, so the autotuned algorithms are picked once per batch shape and
+        reused. Skipped on CPU.
+        """
+        if not torch.cuda.is_available():
+            return
+        
+        torch.backends.cudnn.benchmark = True
+        try:
+            device = model.model.device if hasattr(model.model, 'device') else next(model.parameters()).device
+            with torch.inference_mode():
+                model(torch.zeros(1, 3, imgsz, imgsz, device=device))
+            torch.cuda.synchronize(device)
+            logger.info(f"[Vision] YOLO model warmed up at {imgsz}x{imgsz}")
+        except Exception as e:
+            logger.warning(f"YOLO warmup failed, first frame will be slower: {e}")
+    
+    @staticmethod
+    def configure_thread_budget(cv2_threads: int = 2, reserved_cores: int = 3):
+        """
+        Cap OpenCV and PyTorch thread pools so they don't oversubscribe the CPU
+        when running alongside the real-time capture and detection threads.
+        
+        Process-wide, so it is called by the code that starts real-time
+        detection rather than at import. numpy's BLAS/OpenMP pools are sized
+        when it is first imported; bound those with OMP_NUM_THREADS /
+        MKL_NUM_THREADS in the launcher's environment.
+        """
+        try:
+            import cv2
+            cv2.setNumThreads(cv2_threads)
+        except ImportError:
+            pass
+        
+        if torch is not None:
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) - reserved_cores))
     
     def is_model_loaded(self) -> bool:
         """Check if YOLO model is currently loaded"""
@@ -96,6 +365,8 @@ class ModelManager:
             logger.info("Unloading YOLO model from memory")
             self._yolo_model = None
             self._yolo_model_path = None
+            self._yolo_backend = None
+            self._yolo_imgsz = None
             # Force garbage collection
             import gc
             gc.collect()
@@ -114,5 +385,86 @@ class ModelManager:
         }
 
 
+def _engine_matches(trt, engine_path: str, imgsz: int) -> bool:
+    """
+    True if engine_path exists, deserializes with this TensorRT/GPU and takes
+    a dynamic batch of up to TRT_MAX_BATCH at imgsz x imgsz. Anything else
+    (a static export, another size, a stale build) has to be rebuilt.
+    """
+    if not os.path.exists(engine_path):
+        return False
+    try:
+        with open(engine_path, 'rb') as f:
+            engine = trt.Runtime(trt.Logger(trt.Logger.ERROR)).deserialize_cuda_engine(f.read())
+        if engine is None:
+            return False
+        if hasattr(engine, 'num_io_tensors'):
+            name = next(n for n in (engine.get_tensor_name(i) for i in range(engine.num_io_tensors))
+                        if engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT)
+            shape = tuple(engine.get_tensor_shape(name))
+            max_shape = tuple(engine.get_tensor_profile_shape(name, 0)[2])
+        else:
+            index = next(i for i in range(engine.num_bindings) if engine.binding_is_input(i))
+            shape = tuple(engine.get_binding_shape(index))
+            max_shape = tuple(engine.get_profile_shape(0, index)[2])
+    except Exception as e:
+        logger.warning(f"Ignoring unusable TensorRT engine {engine_path}: {e}")
+        return False
+    
+    if shape[0] != -1 or shape[2:] != (imgsz, imgsz) or max_shape[0] < TRT_MAX_BATCH:
+        logger.warning(f"TensorRT engine {engine_path} has input {shape} (max {max_shape}), rebuilding")
+        return False
+    return True
+
+
+def _make_int8_calibrator(trt, images, imgsz: int, cache_path: str):
+    """
+    Entropy calibrator feeding letterboxed CALIBRATION_BATCH x 3 x imgsz x imgsz
+    batches (preprocessed like the inference path) from GPU memory. Defined
+    here because the base class only exists when TensorRT is installed.
+    """
+    import cv2
+    import numpy as np
+    
+    class Int8Calibrator(trt.IInt8EntropyCalibrator2):
+        def __init__(self):
+            super().__init__()
+            self.index = 0
+            self.batch = torch.empty((CALIBRATION_BATCH, 3, imgsz, imgsz), dtype=torch.float32, device='cuda')
+        
+        def get_batch_size(self):
+            return CALIBRATION_BATCH
+        
+        def get_batch(self, names):
+            if self.index + CALIBRATION_BATCH > len(images):
+                return None
+            host = np.full((CALIBRATION_BATCH, 3, imgsz, imgsz), 114 / 255.0, dtype=np.float32)
+            for i, path in enumerate(images[self.index:self.index + CALIBRATION_BATCH]):
+                frame = cv2.imread(path)
+                if frame is None:
+                    continue
+                h, w = frame.shape[:2]
+                r = min(imgsz / h, imgsz / w)
+                nh, nw = int(round(h * r)), int(round(w * r))
+                top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+                blob = cv2.dnn.blobFromImage(frame, scalefactor=1 / 255.0, size=(nw, nh), swapRB=True)
+                host[i, :, top:top + nh, left:left + nw] = blob[0]
+            self.batch.copy_(torch.from_numpy(host))
+            self.index += CALIBRATION_BATCH
+            return [int(self.batch.data_ptr())]
+        
+        def read_calibration_cache(self):
+            if os.path.exists(cache_path):
+                with open(cache_path, 'rb') as f:
+                    return f.read()
+            return None
+        
+        def write_calibration_cache(self, cache):
+            with open(cache_path, 'wb') as f:
+                f.write(cache)
+    
+    return Int8Calibrator()
+
+
 # Global singleton instance
 model_manager = ModelManager()
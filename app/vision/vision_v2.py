@@ -17,9 +17,34 @@ except ImportError:
 import cv2
 import numpy as np
 import base64
+import hashlib
 import json
 
+import queue
 import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+from typing import Sequence
+
+# Optional SIMD decoders for camera frames; stdlib base64 / cv2.imdecode otherwise
+try:
+    import pybase64 as b64
+except ImportError:
+    b64 = base64
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJPF_GRAY
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _turbo_jpeg = None
+
+# Optional JIT for the fused H-S histogram kernel; cv2.calcHist otherwise
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
 
 # Conditional import for YOLO (may not be installed on Render free tier)
 YOLO = None
@@ -30,15 +55,409 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# YOLO-World weights and the directory holding exported TensorRT/ONNX copies
+WORLD_WEIGHTS = 'yolov8s-worldv2.pt'
+EXPORT_DIR = os.getenv('VISION_EXPORT_DIR', os.path.join('models', 'exported'))
+EXPORT_IMGSZ = 640
+# Largest batch the predict coalescer submits (multiple of 8 for FP16 Tensor Cores)
+PREDICT_MAX_BATCH = 8
+
+
+def _opencv_cuda_available():
+    """True when OpenCV was built with CUDA and a device is present"""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+# Colour-space conversions run on the GPU through cv2.cuda when possible
+USE_CV_CUDA = _opencv_cuda_available()
+
+
+# Per-thread scratch arrays for colour conversions, reused across frames
+_frame_buffers = threading.local()
+
+
+def _thread_buffer(name, shape, dtype=np.uint8):
+    """Calling thread's reusable array for `name`, reallocated only when the frame size changes"""
+    buf = getattr(_frame_buffers, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype=dtype)
+        setattr(_frame_buffers, name, buf)
+    return buf
+
+
+def _convert_colors(img, gray=True, hsv=True):
+    """
+    Grayscale and HSV views of a BGR frame from a single upload on the GPU
+    (or a plain cvtColor on CPU). Conversions not requested are skipped and
+    returned as None.
+    
+    Results are written into per-thread buffers, so in steady state no
+    image-sized arrays are allocated; they are only valid until the same
+    thread converts its next frame.
+    """
+    if not (gray or hsv):
+        return None, None
+    h, w = img.shape[:2]
+    gray_img = _thread_buffer('gray', (h, w)) if gray else None
+    hsv_img = _thread_buffer('hsv', (h, w, 3)) if hsv else None
+    if USE_CV_CUDA:
+        gpu = cv2.cuda_GpuMat()
+        gpu.upload(img)
+        if gray:
+            cv2.cuda.cvtColor(gpu, cv2.COLOR_BGR2GRAY).download(gray_img)
+        if hsv:
+            cv2.cuda.cvtColor(gpu, cv2.COLOR_BGR2HSV).download(hsv_img)
+        return gray_img, hsv_img
+    if gray:
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray_img)
+    if hsv:
+        cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=hsv_img)
+    return gray_img, hsv_img
+
+
+def hamming_distances(des1: np.ndarray, des2: np.ndarray) -> np.ndarray:
+    """
+    (len(des1), len(des2)) int32 Hamming distances between binary descriptors.
+    
+    Computed from the unpacked bits as |a| + |b| - 2 a.b, a single float32
+    matrix product (exact: every term is an integer under 2^24).
+    cv2.batchDistance can't be used here: its Python binding always requests
+    the nearest-index output, which it only allows for K > 0.
+    """
+    a = np.unpackbits(des1, axis=1).astype(np.float32)
+    b = np.unpackbits(des2, axis=1).astype(np.float32)
+    dist = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - 2 * (a @ b.T)
+    return dist.astype(np.int32)
+
+
+def count_good_matches(des1: np.ndarray, des2: np.ndarray, max_distance: int) -> int:
+    """
+    Number of cross-checked ORB matches closer than max_distance.
+    
+    Same result as BFMatcher(NORM_HAMMING, crossCheck=True).match() filtered
+    by distance, but without materialising DMatch objects or sorting: the
+    mutual-nearest check is two argmins over one Hamming distance matrix.
+    Ties go to the lowest index, as in the matcher.
+    """
+    if des1 is None or des2 is None or len(des1) == 0 or len(des2) == 0:
+        return 0
+    dist = hamming_distances(des1, des2)
+    best_j = dist.argmin(axis=1)
+    best_i = dist.argmin(axis=0)
+    rows = np.arange(len(des1))
+    mutual = best_i[best_j] == rows
+    return int(np.count_nonzero(mutual & (dist[rows, best_j] < max_distance)))
+
+
+# Upper bound on the Hamming distance matrix count_good_matches_many builds at once
+MATCH_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def _count_segment_matches(des_refs: np.ndarray, offsets: np.ndarray, des_live: np.ndarray,
+                           max_distance: int) -> np.ndarray:
+    """
+    count_good_matches for consecutive non-empty segments of des_refs
+    (segment k is rows offsets[k]:offsets[k+1]) from one distance matrix.
+    The reverse argmin is taken per segment, first occurrence on ties, so
+    the mutual check is the same as running each segment on its own.
+    """
+    dist = hamming_distances(des_refs, des_live)
+    seg = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    rows = np.arange(len(dist))
+    best_j = dist.argmin(axis=1)
+    # Row r is its segment's argmin for column best_j[r] if it holds the
+    # segment minimum there and no earlier row of the segment does
+    at_min = dist == np.minimum.reduceat(dist, offsets[:-1], axis=0)[seg]
+    seen = np.cumsum(at_min, axis=0, dtype=np.int32)
+    starts = offsets[:-1]
+    seen_before = np.where((starts > 0)[:, None], seen[starts - 1], 0)
+    mutual = at_min[rows, best_j] & (seen[rows, best_j] - seen_before[seg, best_j] == 1)
+    good = mutual & (dist[rows, best_j] < max_distance)
+    return np.add.reduceat(good.astype(np.int32), starts)
+
+
+def count_good_matches_many(des_refs: Sequence[np.ndarray], des_live: np.ndarray, max_distance: int) -> np.ndarray:
+    """
+    count_good_matches(des_refs[k], des_live, max_distance) for every k.
+    
+    References are concatenated (no padding) and matched in chunks whose
+    distance matrix stays under MATCH_CHUNK_BYTES.
+    """
+    counts = np.zeros(len(des_refs), dtype=np.int32)
+    if des_live is None or len(des_live) == 0:
+        return counts
+    max_rows = max(1, MATCH_CHUNK_BYTES // (4 * len(des_live)))
+    
+    chunk, chunk_rows = [], 0
+    for k, des in enumerate(des_refs):
+        if des is None or len(des) == 0:
+            continue
+        if chunk and chunk_rows + len(des) > max_rows:
+            counts[chunk] = _match_chunk(des_refs, chunk, des_live, max_distance)
+            chunk, chunk_rows = [], 0
+        chunk.append(k)
+        chunk_rows += len(des)
+    if chunk:
+        counts[chunk] = _match_chunk(des_refs, chunk, des_live, max_distance)
+    return counts
+
+
+def _match_chunk(des_refs, indices, des_live, max_distance):
+    offsets = np.concatenate([[0], np.cumsum([len(des_refs[k]) for k in indices])])
+    stacked = np.concatenate([des_refs[k] for k in indices])
+    return _count_segment_matches(stacked, offsets, des_live, max_distance)
+
+
+def _exif_orientation(buf: bytes) -> int:
+    """EXIF orientation tag of a JPEG (1 = upright, also when there is no tag)"""
+    i = 2
+    while i + 4 <= len(buf) and buf[i] == 0xFF:
+        marker = buf[i + 1]
+        if marker in (0xDA, 0xD9):  # image data / end: metadata comes before this
+            break
+        length = int.from_bytes(buf[i + 2:i + 4], 'big')
+        if marker == 0xE1 and buf[i + 4:i + 10] == b'Exif\x00\x00':
+            tiff = buf[i + 10:i + 2 + length]
+            order = 'little' if tiff[:2] == b'II' else 'big'
+            ifd = int.from_bytes(tiff[4:8], order)
+            for k in range(int.from_bytes(tiff[ifd:ifd + 2], order)):
+                entry = ifd + 2 + 12 * k
+                if int.from_bytes(tiff[entry:entry + 2], order) == 0x0112:
+                    return int.from_bytes(tiff[entry + 8:entry + 10], order)
+            return 1
+        i += 2 + length
+    return 1
+
+
+def _decode_image(encoded_data: str, grayscale: bool = False):
+    """
+    Base64 payload -> BGR (or grayscale) ndarray, or None if undecodable.
+    JPEGs go through libjpeg-turbo's own API when PyTurboJPEG is installed;
+    other formats, failures and rotated JPEGs fall back to cv2.imdecode.
+    TurboJPEG ignores the EXIF orientation that imdecode applies, so phone
+    photos tagged as rotated are left to imdecode to come out upright.
+    """
+    buf = b64.b64decode(encoded_data)
+    if _turbo_jpeg is not None and buf[:2] == b'\xff\xd8' and _exif_orientation(buf) == 1:
+        try:
+            img = _turbo_jpeg.decode(buf, pixel_format=TJPF_GRAY if grayscale else TJPF_BGR)
+            return img[:, :, 0] if grayscale else img
+        except Exception:
+            pass
+    return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+
+
+HIST_BINS_H, HIST_BINS_S = 50, 60
+
+if numba is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _hs_hist_norm(hsv, n_chunks):
+        """
+        50x60 H-S histogram of an HSV image, min-max normalized to [0, 1].
+        Binning matches cv2.calcHist with ranges [0, 180) x [0, 256). Each
+        chunk of rows fills its own tile; tiles are summed at the end.
+        """
+        rows = hsv.shape[0]
+        tiles = np.zeros((n_chunks, HIST_BINS_H * HIST_BINS_S), dtype=np.int32)
+        step = (rows + n_chunks - 1) // n_chunks
+        for c in prange(n_chunks):
+            tile = tiles[c]
+            for y in range(c * step, min(rows, (c + 1) * step)):
+                for x in range(hsv.shape[1]):
+                    hb = hsv[y, x, 0] * HIST_BINS_H // 180
+                    sb = hsv[y, x, 1] * HIST_BINS_S // 256
+                    if hb < HIST_BINS_H:
+                        tile[hb * HIST_BINS_S + sb] += 1
+        
+        hist = tiles.sum(axis=0).astype(np.float32)
+        lo, hi = hist.min(), hist.max()
+        if hi > lo:
+            return (hist - lo) / (hi - lo)
+        return np.zeros_like(hist)
+
+
+# ORB fingerprints are stored as "orb:<scale>:<nfeatures>:<base64>" so a live
+# frame can be described the same way the reference was. Untagged strings
+# predate the tag and were extracted at full resolution with 2000 features.
+ORB_TAG = 'orb'
+LEGACY_ORB_PROFILE = (1.0, 2000)
+
+
+def _split_orb_fingerprint(fingerprint: str):
+    """Stored ORB fingerprint -> ((scale, nfeatures), base64 payload)"""
+    if fingerprint.startswith(ORB_TAG + ':'):
+        _, scale, nfeatures, payload = fingerprint.split(':', 3)
+        return (float(scale), int(nfeatures)), payload
+    return LEGACY_ORB_PROFILE, fingerprint
+
+
+@lru_cache(maxsize=256)
+def _decode_orb_descriptors(fingerprint: str) -> np.ndarray:
+    """Stored ORB fingerprint -> read-only (N, 32) uint8 descriptors (cached per string)"""
+    _, payload = _split_orb_fingerprint(fingerprint)
+    return np.frombuffer(b64.b64decode(payload), np.uint8).reshape(-1, 32)
+
+
+@lru_cache(maxsize=256)
+def _decode_histogram(histogram_b64: str) -> np.ndarray:
+    """
+    Stored histogram fingerprint -> read-only array (cached per string).
+    New fingerprints are uint8 (one byte per bin); older ones are float32.
+    Correlation is scale-invariant, so either compares directly against a
+    live [0, 1] histogram.
+    """
+    raw = b64.b64decode(histogram_b64)
+    if len(raw) == HIST_BINS_H * HIST_BINS_S:
+        return np.frombuffer(raw, dtype=np.uint8)
+    return np.frombuffer(raw, dtype=np.float32)
+
+
+def _export_tag(classes, device):
+    """
+    Cache key for an exported detector. YOLO-World bakes the text embeddings
+    of its class list into the export, and TensorRT engines only run on the
+    GPU architecture / TensorRT version they were built with.
+    """
+    digest = hashlib.sha1('|'.join(classes).encode('utf-8')).hexdigest()[:8]
+    if device == 'cuda':
+        import tensorrt
+        major, minor = torch.cuda.get_device_capability()
+        return f"sm{major}{minor}-trt{tensorrt.__version__}-{digest}"
+    return f"cpu-{digest}"
+
+
+def _load_world_detector(classes, device):
+    """
+    YOLO-World detector for a fixed class list. Runs through a cached FP16
+    TensorRT engine on GPU or an ONNX export on CPU, exporting on first use;
+    falls back to the PyTorch weights if exporting isn't possible.
+    
+    Returns:
+        (model, exported): exported is False for the PyTorch fallback
+    """
+    model = YOLO(WORLD_WEIGHTS)
+    model.to(device)
+    model.set_classes(classes)
+    
+    fmt = 'engine' if device == 'cuda' else 'onnx'
+    try:
+        stem = os.path.splitext(os.path.basename(WORLD_WEIGHTS))[0]
+        export_path = os.path.join(EXPORT_DIR, f"{stem}-{_export_tag(classes, device)}.{fmt}")
+        if not os.path.exists(export_path):
+            os.makedirs(EXPORT_DIR, exist_ok=True)
+            # Dynamic batch axis (up to PREDICT_MAX_BATCH) so coalesced frames share a call
+            exported = model.export(format=fmt, half=(device == 'cuda'), imgsz=EXPORT_IMGSZ,
+                                    dynamic=True, batch=PREDICT_MAX_BATCH,
+                                    device=0 if device == 'cuda' else 'cpu')
+            os.replace(exported, export_path)
+            logger.info(f"Exported YOLO-World ({', '.join(classes)}) to {export_path}")
+        return YOLO(export_path, task='detect'), True
+    except Exception as e:
+        logger.warning(f"YOLO-World {fmt} export unavailable, using PyTorch weights: {e}")
+        return model, False
+
+
+def _enable_cuda_graphs(model):
+    """
+    Compile the eager network with mode='reduce-overhead' so each forward
+    replays a captured CUDA graph instead of launching every kernel from
+    Python. Camera frames have a fixed size, so one graph per batch size is
+    captured and reused. Warmed up here; restores eager mode on failure.
+    
+    Graphs are recorded for the capturing thread and its current stream, so
+    this must run on the thread that will replay them (the batcher worker,
+    see _BatchedPredictor).
+    """
+    if not hasattr(torch, 'compile'):
+        return
+    eager_model = model.model
+    try:
+        model.model = torch.compile(eager_model, mode='reduce-overhead', dynamic=False)
+        model.predict(np.zeros((EXPORT_IMGSZ, EXPORT_IMGSZ, 3), dtype=np.uint8), verbose=False)
+        logger.info("YOLO-World forward captured as CUDA graph")
+    except Exception as e:
+        model.model = eager_model
+        logger.warning(f"CUDA graph capture unavailable for YOLO-World, using eager mode: {e}")
+
+
+class _BatchedPredictor:
+    """
+    Coalesces concurrent single-frame predict() calls into one batched call.
+    
+    Request threads enqueue (frame, future) and block on the future; a worker
+    drains up to PREDICT_MAX_BATCH frames arriving within a short window and
+    runs them through the model together, so the backbone sees a real batch
+    instead of B=1 under load. A lone request waits at most one window.
+    
+    With cuda_graphs=True the model is compiled and warmed up on the worker
+    thread before it serves requests, so CUDA graphs are captured on the same
+    thread and stream that replays them; `ready` is set once that is done.
+    """
+    
+    WINDOW_SECONDS = 0.010
+    
+    def __init__(self, model, conf, cuda_graphs=False):
+        self.model = model
+        self.conf = conf
+        self.cuda_graphs = cuda_graphs
+        self.ready = threading.Event()
+        self._queue = queue.Queue()
+        threading.Thread(target=self._worker, daemon=True).start()
+    
+    def predict(self, img):
+        """Results for a single frame (same object as model.predict(img)[0])"""
+        future = Future()
+        self._queue.put((img, future))
+        return future.result()
+    
+    def _worker(self):
+        if self.cuda_graphs:
+            _enable_cuda_graphs(self.model)
+        self.ready.set()
+        
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.WINDOW_SECONDS
+            while len(batch) < PREDICT_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                results = self.model.predict([img for img, _ in batch], conf=self.conf, verbose=False)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
 
 class VisionEngineV2:
     """
     Triple-Layer Verification Engine for Medication Detection.
     """
     
+    # YOLO-World vocabularies, one detector each. They are not merged: NMS
+    # keeps a single class per box, so a shared vocabulary would relabel boxes
+    # (e.g. "medicine bottle" -> "bottle") and change what each endpoint sees.
+    MEDICINE_CLASSES = ["medicine package", "medicine bottle", "pill strip", "inhaler"]
+    HAND_CLASSES = ["human hand", "hand", "pill bottle", "medicine bottle", "bottle"]
+    DETECT_CONFIDENCE = 0.30
+    HAND_CONFIDENCE = 0.35
+    
     # Layer thresholds (tunable)
     YOLO_CONFIDENCE_THRESHOLD = 0.60
+    YOLO_EMPTY_THRESHOLD = 0.20  # below this there is definitely no medicine in frame
     ORB_MATCH_THRESHOLD = 15
+    ORB_FEATURES = 500
+    ORB_SCALE = 0.5  # ORB runs on a half-resolution grayscale frame
     HISTOGRAM_CORRELATION_THRESHOLD = 0.65
     
     def __init__(self):
@@ -49,9 +468,12 @@ class VisionEngineV2:
         self.models_loaded = False  # Flag to track async loading status
         self.detector = None
         self.hand_detector = None
+        self._detect_batcher = None
+        self._hand_batcher = None
 
         # ORB for precision fingerprinting (Layer 2) - Fast, can init immediately
-        self.orb = cv2.ORB_create(nfeatures=2000)
+        self.orb = cv2.ORB_create(nfeatures=self.ORB_FEATURES)
+        self._orb_by_features = {self.ORB_FEATURES: self.orb}  # one detector per fingerprint profile
         self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
         
         # Start async model loading
@@ -72,14 +494,21 @@ class VisionEngineV2:
             device = 'cuda' if torch.cuda.is_available() else 'cpu'
             
             # Medicine detector
-            self.detector = YOLO('yolov8s-worldv2.pt') 
-            self.detector.to(device)
-            self.detector.set_classes(["medicine package", "medicine bottle", "pill strip", "inhaler"])
+            self.detector, detector_exported = _load_world_detector(self.MEDICINE_CLASSES, device)
             
             # Hand detector (separate instance for robust hand detection)
-            self.hand_detector = YOLO('yolov8s-worldv2.pt')
-            self.hand_detector.to(device)
-            self.hand_detector.set_classes(["human hand", "hand", "pill bottle", "medicine bottle", "bottle"])
+            self.hand_detector, hand_exported = _load_world_detector(self.HAND_CLASSES, device)
+            
+            # Concurrent requests share forward passes through these. The
+            # PyTorch fallback on GPU replays CUDA graphs, captured by each
+            # batcher on its own worker thread; wait for that warm-up
+            cuda = device == 'cuda'
+            self._detect_batcher = _BatchedPredictor(
+                self.detector, conf=self.DETECT_CONFIDENCE, cuda_graphs=cuda and not detector_exported)
+            self._hand_batcher = _BatchedPredictor(
+                self.hand_detector, conf=self.HAND_CONFIDENCE, cuda_graphs=cuda and not hand_exported)
+            self._detect_batcher.ready.wait()
+            self._hand_batcher.ready.wait()
             
             self.models_loaded = True
             logger.info(f"YOLO-World initialized on {device} (medicine + hand detectors)")
@@ -94,7 +523,27 @@ class VisionEngineV2:
             # We don't verify self.vision_available = False here to allow retries if we wanted, 
             # but effectively vision is broken.
 
-    def compute_color_histogram(self, image: np.ndarray) -> np.ndarray:
+    @property
+    def orb_profile(self):
+        """(scale, nfeatures) new fingerprints are extracted with"""
+        return (self.ORB_SCALE, self.ORB_FEATURES)
+
+    def _orb_features(self, gray: np.ndarray, profile=None):
+        """
+        ORB keypoints/descriptors on a grayscale image downscaled by the
+        profile's scale. Live frames are described with the profile of the
+        fingerprint they are compared against (default: orb_profile), so
+        legacy full-resolution fingerprints still match like for like.
+        """
+        scale, nfeatures = profile or self.orb_profile
+        orb = self._orb_by_features.get(nfeatures)
+        if orb is None:
+            orb = self._orb_by_features[nfeatures] = cv2.ORB_create(nfeatures=nfeatures)
+        if scale != 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return orb.detectAndCompute(gray, None)
+
+    def compute_color_histogram(self, image: np.ndarray, hsv: np.ndarray = None) -> np.ndarray:
         """
         Layer 3: Compute normalized color histogram in HSV space.
         
@@ -103,22 +552,28 @@ class VisionEngineV2:
         
         Args:
             image: BGR image (OpenCV format)
+            hsv: Optional precomputed HSV version of image
             
         Returns:
             Flattened, normalized histogram array
         """
         try:
             # Convert to HSV (more robust to lighting)
-            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            if hsv is None:
+                _, hsv = _convert_colors(image, gray=False)
             
             # Compute 2D histogram on H and S channels
             # H: 0-179 (180 bins), S: 0-255 (256 bins)
             # Using 50 bins for H and 60 bins for S for efficiency
+            if numba is not None:
+                # Bin + normalize fused into one parallel pass over the pixels
+                return _hs_hist_norm(np.ascontiguousarray(hsv), numba.get_num_threads())
+            
             hist = cv2.calcHist(
                 [hsv], 
                 [0, 1],  # H and S channels
                 None, 
-                [50, 60],  # Number of bins
+                [HIST_BINS_H, HIST_BINS_S],  # Number of bins
                 [0, 180, 0, 256]  # Ranges
             )
             
@@ -136,7 +591,8 @@ class VisionEngineV2:
         Compare two histograms using correlation method.
         
         Returns:
-            Correlation score between -1 and 1 (higher is better)
+            Correlation score between -1 and 1 (higher is better); 0 when
+            either histogram is constant (correlation is undefined there)
         """
         if hist1 is None or hist2 is None:
             return 0.0
@@ -146,6 +602,10 @@ class VisionEngineV2:
             h1 = hist1.reshape(-1, 1).astype(np.float32)
             h2 = hist2.reshape(-1, 1).astype(np.float32)
             
+            # compareHist reports 1.0 for a constant histogram; that is no evidence of a match
+            if np.ptp(h1) == 0 or np.ptp(h2) == 0:
+                return 0.0
+            
             # Use correlation method (CV_COMP_CORREL)
             score = cv2.compareHist(h1, h2, cv2.HISTCMP_CORREL)
             return float(score)
@@ -154,6 +614,27 @@ class VisionEngineV2:
             logger.error(f"Histogram comparison failed: {e}")
             return 0.0
 
+    def compare_histograms_batch(self, references: np.ndarray, live_hist: np.ndarray) -> np.ndarray:
+        """
+        Correlate one live histogram against N reference histograms at once.
+        
+        Same score as compare_histograms (cv2.HISTCMP_CORREL) for every row of
+        an (N, D) reference matrix, computed as a single matrix-vector product
+        instead of N separate compareHist calls.
+        
+        Returns:
+            (N,) float32 array of correlation scores, 0 for constant rows
+        """
+        refs = np.asarray(references, dtype=np.float32).reshape(-1, live_hist.size)
+        live = live_hist.astype(np.float32).ravel()
+        
+        refs_c = refs - refs.mean(axis=1, keepdims=True)
+        live_c = live - live.mean()
+        denom = np.sqrt(np.einsum('ij,ij->i', refs_c, refs_c) * live_c.dot(live_c))
+        scores = refs_c @ live_c
+        # Zero variance: correlation is undefined, never a match (see compare_histograms)
+        return np.divide(scores, denom, out=np.zeros_like(scores), where=denom > 1e-12)
+
     def detect_hand(self, image_base64: str) -> dict:
         """
         Detect if a human hand is present in the frame using YOLO.
@@ -178,8 +659,7 @@ class VisionEngineV2:
                 encoded_data = image_base64.split(',')[1]
             else:
                 encoded_data = image_base64
-            nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            img = _decode_image(encoded_data)
             
             if img is None:
                 print("[DEBUG] Image decoding failed!")
@@ -191,14 +671,14 @@ class VisionEngineV2:
             cv2.imwrite('debug_frames/last_detect_attempt.jpg', img)
             print(f"[DEBUG] Image decoded. Shape: {img.shape}")
             
-            # Run YOLO hand detection (conf=0.35)
-            results = self.hand_detector.predict(img, conf=0.35, verbose=False)
+            # Run YOLO hand detection (conf=0.35), batched with concurrent requests
+            result = self._hand_batcher.predict(img)
             
             all_detections = []
             best_hand_conf = 0.0
             best_hand_box = None
             
-            for box in results[0].boxes:
+            for box in result.boxes:
                 cls = int(box.cls[0])
                 label = self.hand_detector.names[cls]
                 conf = float(box.conf[0])
@@ -241,14 +721,17 @@ class VisionEngineV2:
             logger.error(f"Hand detection error: {e}")
             return {'success': False, 'hand_detected': False, 'error': str(e)}
 
-    def process_frame(self, image_base64, expected_features=None, reference_histogram=None, reference_embedding=None):
+    def process_frame(self, image_base64, expected_features=None, reference_histogram=None, reference_embedding=None,
+                      expected_profile=None):
         """
         Quad-Layer Verification Pipeline with Multi-Angle Robustness.
         
         Args:
             image_base64: Base64 encoded camera frame
             expected_features: Stored ORB descriptors
-            reference_histogram: Stored color histogram
+            expected_profile: (scale, nfeatures) the descriptors were extracted
+                with, from orb_fingerprint_profile(); defaults to orb_profile
+            reference_histogram: Stored color histogram, or an (N, D) stack of them
             reference_embedding: List of stored deep embeddings (one per angle)
             
         Returns:
@@ -276,9 +759,9 @@ class VisionEngineV2:
         # Decode image
         try:
             encoded_data = image_base64.split(',')[1]
-            nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            img = _decode_image(encoded_data)
+            if img is None:
+                raise ValueError("image could not be decoded")
         except Exception as e:
             return {'success': False, 'error': f"Decode failed: {e}"}
 
@@ -286,11 +769,12 @@ class VisionEngineV2:
         layer1_pass = False
         best_confidence = 0.0
         detections = []
+        best_bbox = None
         
         if self.detector:
-            results = self.detector.predict(img, conf=0.3, verbose=False)
-            if len(results[0].boxes) > 0:
-                for box in results[0].boxes:
+            result = self._detect_batcher.predict(img)
+            if len(result.boxes) > 0:
+                for box in result.boxes:
                     coords = box.xyxy[0].tolist()
                     conf = float(box.conf[0])
                     cls = int(box.cls[0])
@@ -302,23 +786,52 @@ class VisionEngineV2:
                     })
                     if conf > best_confidence:
                         best_confidence = conf
+                        best_bbox = coords
                 
                 # Layer 1 passes if any detection >= threshold
                 layer1_pass = best_confidence >= self.YOLO_CONFIDENCE_THRESHOLD
                 logger.info(f"Layer 1 (YOLO): {'PASS' if layer1_pass else 'FAIL'} - Best confidence: {best_confidence:.2%}")
 
+            # Nothing resembling a medicine in frame. Without ORB features the
+            # other layers can't outvote a failed detection, so skip them; with
+            # features a label match still verifies on its own (see the vote
+            # below), so ORB has to run
+            if best_confidence < self.YOLO_EMPTY_THRESHOLD and expected_features is None:
+                return {
+                    'success': True,
+                    'is_verified': False,
+                    'layer1_detection': False,
+                    'detection_confidence': best_confidence,
+                    'detections': detections,
+                    'layer2_features': False,
+                    'match_count': 0,
+                    'layer3_histogram': False,
+                    'histogram_score': 0.0,
+                    'layers_checked': ['detection'],
+                    'layers_passed': [],
+                    'message': "⏳ No medication detected - hold it up to the camera"
+                }
+
+        # Both colour spaces from one pass, and only the ones a layer will use
+        gray, hsv = _convert_colors(img, gray=expected_features is not None,
+                                    hsv=reference_histogram is not None)
+
         # ===== LAYER 2: Feature Matching (ORB) =====
         layer2_pass = False
         match_count = 0
         
         if expected_features is not None:
-            kp_live, des_live = self.orb.detectAndCompute(gray, None)
+            if best_bbox is not None:
+                # Match only inside the detected package: fewer pixels, no background keypoints
+                x1, y1, x2, y2 = (int(round(v)) for v in best_bbox)
+                crop = gray[max(y1, 0):y2, max(x1, 0):x2]
+                if crop.size:
+                    gray = crop
+            kp_live, des_live = self._orb_features(gray, expected_profile)
             if des_live is not None:
                 try:
-                    matches = self.bf.match(expected_features, des_live)
-                    matches = sorted(matches, key=lambda x: x.distance)
-                    good_matches = [m for m in matches if m.distance < 40]  # Balanced (was 35, too strict)
-                    match_count = len(good_matches)
+                    # Cross-checked matches under distance 40 (Balanced; was 35, too strict)
+                    match_count = count_good_matches(expected_features, des_live, 40)
                     
                     # Layer 2 passes if matches >= threshold
                     layer2_pass = match_count >= self.ORB_MATCH_THRESHOLD
@@ -331,9 +844,13 @@ class VisionEngineV2:
         histogram_score = 0.0
         
         if reference_histogram is not None:
-            live_histogram = self.compute_color_histogram(img)
+            live_histogram = self.compute_color_histogram(img, hsv=hsv)
             if live_histogram is not None:
-                histogram_score = self.compare_histograms(reference_histogram, live_histogram)
+                if np.ndim(reference_histogram) == 2:
+                    # Several stored angles: best correlation in one vectorized pass
+                    histogram_score = float(self.compare_histograms_batch(reference_histogram, live_histogram).max())
+                else:
+                    histogram_score = self.compare_histograms(reference_histogram, live_histogram)
                 
                 # Layer 3 passes if correlation >= threshold
                 layer3_pass = histogram_score >= self.HISTOGRAM_CORRELATION_THRESHOLD
@@ -456,11 +973,12 @@ class VisionEngineV2:
         """Extract ORB descriptors for a new medicine to save in DB (Layer 2 reference)."""
         try:
             encoded_data = image_base64.split(',')[1]
-            nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-            kp, des = self.orb.detectAndCompute(img, None)
+            img = _decode_image(encoded_data, grayscale=True)
+            kp, des = self._orb_features(img)
             if des is not None:
-                return base64.b64encode(des.tobytes()).decode('utf-8')
+                scale, nfeatures = self.orb_profile
+                payload = base64.b64encode(des.tobytes()).decode('utf-8')
+                return f"{ORB_TAG}:{scale}:{nfeatures}:{payload}"
         except Exception as e:
             logger.error(f"Fingerprint extraction failed: {e}")
         return None
@@ -469,12 +987,13 @@ class VisionEngineV2:
         """Extract color histogram for a new medicine to save in DB (Layer 3 reference)."""
         try:
             encoded_data = image_base64.split(',')[1]
-            nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            img = _decode_image(encoded_data)
             
             hist = self.compute_color_histogram(img)
             if hist is not None:
-                return base64.b64encode(hist.astype(np.float32).tobytes()).decode('utf-8')
+                # Quantized to one byte per bin: 3KB instead of 12KB per medication
+                quantized = np.rint(hist * 255).astype(np.uint8)
+                return base64.b64encode(quantized.tobytes()).decode('utf-8')
         except Exception as e:
             logger.error(f"Histogram extraction failed: {e}")
         return None
@@ -484,15 +1003,123 @@ class VisionEngineV2:
         from app.services.embedding_service import embedding_service
         return embedding_service.extract_embedding(image_base64)
 
+    def decode_orb_fingerprint(self, fingerprint_b64: str) -> np.ndarray:
+        """
+        Decode a stored ORB fingerprint from base64.
+        
+        Decoded arrays are cached by fingerprint, so repeat verifications of the
+        same medication skip the base64 decode; retraining changes the string
+        and therefore the cache key.
+        """
+        return _decode_orb_descriptors(fingerprint_b64)
+
+    def orb_fingerprint_profile(self, fingerprint_b64: str):
+        """
+        (scale, nfeatures) a stored ORB fingerprint was extracted with; pass
+        it to process_frame(expected_profile=...) with the decoded descriptors.
+        """
+        return _split_orb_fingerprint(fingerprint_b64)[0]
+
     def decode_histogram_fingerprint(self, histogram_b64: str) -> np.ndarray:
-        """Decode a stored histogram fingerprint from base64."""
+        """Decode a stored histogram fingerprint from base64 (cached like ORB fingerprints)."""
         try:
-            hist_bytes = base64.b64decode(histogram_b64)
-            return np.frombuffer(hist_bytes, dtype=np.float32)
+            return _decode_histogram(histogram_b64)
         except Exception as e:
             logger.error(f"Histogram decode failed: {e}")
             return None
 
+    def load_references(self, medications) -> dict:
+        """
+        Pack the stored ORB and histogram fingerprints of many medications
+        into flat arrays (one row per medication) for score_references().
+        
+        Args:
+            medications: iterable of Medication rows
+            
+        Returns:
+            Dict of 'med_ids' (N,) int64, 'orb' (total descriptors, 32) uint8
+            with medication i at rows orb_offsets[i]:orb_offsets[i + 1],
+            'orb_offsets' (N + 1,) int64, 'orb_profile' (one (scale, nfeatures)
+            per row), 'hist' (N, D) float32 and 'has_hist' (N,) bool
+        """
+        med_ids, orbs, profiles, hists = [], [], [], []
+        for med in medications:
+            med_ids.append(med.id)
+            orb = None
+            profile = self.orb_profile
+            if med.visual_fingerprint:
+                orb = self.decode_orb_fingerprint(med.visual_fingerprint)
+                profile = self.orb_fingerprint_profile(med.visual_fingerprint)
+            profiles.append(profile)
+            orbs.append(orb if orb is not None else np.empty((0, 32), np.uint8))
+            hist = None
+            if med.histogram_fingerprint:
+                hist = self.decode_histogram_fingerprint(med.histogram_fingerprint)
+            hists.append(hist)
+        
+        n = len(med_ids)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(o) for o in orbs])
+        hist_arr = np.zeros((n, HIST_BINS_H * HIST_BINS_S), dtype=np.float32)
+        has_hist = np.zeros(n, dtype=bool)
+        for i, hist in enumerate(hists):
+            if hist is not None and hist.size == hist_arr.shape[1]:
+                hist_arr[i] = hist
+                has_hist[i] = True
+        
+        return {
+            'med_ids': np.asarray(med_ids, dtype=np.int64),
+            'orb': np.concatenate(orbs) if n else np.empty((0, 32), np.uint8),
+            'orb_offsets': offsets,
+            'orb_profile': profiles,
+            'hist': hist_arr,
+            'has_hist': has_hist,
+        }
+
+    def score_references(self, image_base64: str, references: dict) -> dict:
+        """
+        Score one frame against every medication packed by load_references()
+        with array operations instead of a per-medication loop: the live frame
+        is described once per distinct fingerprint profile and matched against
+        all medications of that profile in chunked distance matrices, and the
+        histograms are correlated in one batch.
+        
+        Scores equal process_frame's Layer 2 / Layer 3 values for a
+        whole-frame comparison against each medication on its own.
+        
+        Returns:
+            Dict of 'med_ids', 'match_counts' (N,) cross-checked matches under
+            distance 40, and 'histogram_scores' (N,), 0 where a medication
+            has no histogram fingerprint
+        """
+        encoded_data = image_base64.split(',')[1]
+        img = _decode_image(encoded_data)
+        if img is None:
+            raise ValueError("image could not be decoded")
+        gray, hsv = _convert_colors(img)
+        
+        orb, offsets = references['orb'], references['orb_offsets']
+        n = len(references['med_ids'])
+        match_counts = np.zeros(n, dtype=np.int32)
+        profiles = references['orb_profile']
+        for profile in (set(profiles) if len(orb) else ()):
+            rows = [i for i, p in enumerate(profiles) if p == profile]
+            _, des_live = self._orb_features(gray, profile)
+            match_counts[rows] = count_good_matches_many(
+                [orb[offsets[i]:offsets[i + 1]] for i in rows], des_live, 40)
+        
+        histogram_scores = np.zeros(n, dtype=np.float32)
+        live_hist = self.compute_color_histogram(img, hsv=hsv)
+        if live_hist is not None and references['has_hist'].any():
+            has_hist = references['has_hist']
+            histogram_scores[has_hist] = self.compare_histograms_batch(references['hist'][has_hist], live_hist)
+        
+        return {
+            'med_ids': references['med_ids'],
+            'match_counts': match_counts,
+            'histogram_scores': histogram_scores,
+        }
+
 
 # Singleton instance
 vision_v2 = VisionEngineV2()
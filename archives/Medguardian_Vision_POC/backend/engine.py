@@ -4,12 +4,30 @@ import base64
 import os
 import json
 
+# Optional: binary ANN index for matching against many templates at once
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Below this many templates the per-template BFMatcher loop is cheap enough
+FAISS_MIN_TEMPLATES = 20
+
+
+def decode_gray(image_base64):
+    """Data-URL base64 frame -> grayscale ndarray"""
+    encoded_data = image_base64.split(',')[1]
+    nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
+    return cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+
+
 class VisionEngine:
     def __init__(self, data_dir='data'):
         self.orb = cv2.ORB_create(nfeatures=1500)
         self.bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
         self.data_dir = data_dir
         self.templates = {} # name -> {descriptors, keypoints, shape}
+        self._index = None  # faiss index over all template descriptors (built lazily)
         self.load_templates()
 
     def load_templates(self):
@@ -25,14 +43,50 @@ class VisionEngine:
                     'descriptors': data['descriptors'],
                     'shape': data['shape']
                 }
+        self._index = None
         print(f"Loaded {len(self.templates)} medicine templates.")
 
+    def _build_index(self):
+        """Index every template descriptor, tagged with its template, in one binary IVF index"""
+        names = list(self.templates)
+        descs = [np.asarray(self.templates[n]['descriptors'], dtype=np.uint8) for n in names]
+        all_des = np.ascontiguousarray(np.vstack(descs))
+        bits = all_des.shape[1] * 8
+        
+        nlist = 16
+        self._quantizer = faiss.IndexBinaryFlat(bits)
+        if len(all_des) >= nlist * 39:  # enough points to train the coarse quantizer
+            index = faiss.IndexBinaryIVF(self._quantizer, bits, nlist)
+            index.train(all_des)
+            index.nprobe = 4
+        else:
+            index = self._quantizer
+        index.add(all_des)
+        
+        self._index = index
+        self._index_names = names
+        self._index_owner = np.repeat(np.arange(len(names)), [len(d) for d in descs])
+
+    def _verify_indexed(self, des_frame, min_matches):
+        """Vote each live descriptor's nearest template descriptor; best-voted template wins"""
+        if self._index is None:
+            self._build_index()
+        dist, idx = self._index.search(np.ascontiguousarray(des_frame, dtype=np.uint8), 1)
+        good = (idx[:, 0] >= 0) & (dist[:, 0] < 40)
+        votes = np.bincount(self._index_owner[idx[good, 0]], minlength=len(self._index_names))
+        best = int(votes.argmax())
+        if votes[best] > min_matches:
+            return {
+                'name': self._index_names[best],
+                'confidence': int(votes[best]),
+                'status': 'MATCHED'
+            }
+        return None
+
     def register(self, name, image_base64):
         """Extract features from a new medicine image and save"""
         # Decode image
-        encoded_data = image_base64.split(',')[1]
-        nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+        img = decode_gray(image_base64)
 
         # Detect features
         kp, des = self.orb.detectAndCompute(img, None)
@@ -47,14 +101,13 @@ class VisionEngine:
                 'descriptors': des,
                 'shape': img.shape
             }
+            self._index = None
             return True
         return False
 
     def verify(self, frame_base64):
         """Match frame against all stored templates"""
-        encoded_data = frame_base64.split(',')[1]
-        nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+        frame = decode_gray(frame_base64)
 
         kp_frame, des_frame = self.orb.detectAndCompute(frame, None)
         
@@ -64,19 +117,22 @@ class VisionEngine:
         best_match = None
         min_matches = 20 # Minimum good matches to consider a hit
 
+        if faiss is not None and len(self.templates) >= FAISS_MIN_TEMPLATES:
+            return self._verify_indexed(des_frame, min_matches)
+
         for name, template in self.templates.items():
             matches = self.bf.match(template['descriptors'], des_frame)
-            matches = sorted(matches, key=lambda x: x.distance)
             
-            # Simple thresholding
-            good_matches = [m for m in matches if m.distance < 40]
+            # Simple thresholding (only the count matters, so no sort)
+            dists = np.fromiter((m.distance for m in matches), dtype=np.float32, count=len(matches))
+            good_count = int(np.count_nonzero(dists < 40))
             
-            if len(good_matches) > min_matches:
+            if good_count > min_matches:
                 # We found a match! 
                 # Note: In a real app we'd use findHomography for precise corners
                 return {
                     'name': name,
-                    'confidence': len(good_matches),
+                    'confidence': good_count,
                     'status': 'MATCHED'
                 }
 
@@ -3,10 +3,26 @@ import numpy as np
 import time
 import threading
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from .bottle_detector import MedicineBottleDetector
 from .enhanced_camera import EnhancedCameraInterface
 from .barcode_scanner import BarcodeScanner
+from app.vision.model_manager import ModelManager
+
+
+@lru_cache(maxsize=256)
+def _expected_barcodes(medication_id: int) -> frozenset:
+    """Barcode payloads accepted for a medication (cached per id)"""
+    return frozenset({f"MED_{medication_id}"})
+
 
 class EnhancedMedicationVerifier:
     """
@@ -30,6 +46,12 @@ class EnhancedMedicationVerifier:
         self.detection_callback = None
         self.last_detection_result = None
         
+        # Reusable annotated-frame buffer for the real-time loop (sized on first frame)
+        self._annot_buf = None
+        
+        # Single writer thread so saving results never blocks the detection path
+        self._io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detection-io")
+        
         # Detection parameters
         self.confidence_threshold = 0.5
         self.min_bottle_count = 1
@@ -87,7 +109,7 @@ class EnhancedMedicationVerifier:
                 
                 # Track best result
                 if result['detected_bottles'] > 0:
-                    avg_confidence = np.mean([d[4] for d in result['detections']])
+                    avg_confidence = float(result['detections'][:, 4].mean())
                     if avg_confidence > best_confidence:
                         best_confidence = avg_confidence
                         best_result = result
@@ -148,12 +170,25 @@ class EnhancedMedicationVerifier:
         except Exception as e:
             return self._create_error_result(f"Image verification error: {str(e)}")
     
-    def _process_image(self, image: np.ndarray, expected_medication_id: int = None) -> Dict:
-        """Process a single image for bottle detection"""
+    def _process_image(self, image: np.ndarray, expected_medication_id: int = None,
+                       reuse_buffer: bool = False) -> Dict:
+        """
+        Process a single image for bottle detection
+        
+        With reuse_buffer=True the annotated image is drawn into a buffer shared
+        across calls, so it is only valid until the next frame is processed.
+        """
         try:
+            dst = None
+            if reuse_buffer:
+                if (self._annot_buf is None or self._annot_buf.shape != image.shape
+                        or self._annot_buf.dtype != image.dtype):
+                    self._annot_buf = np.empty_like(image)
+                dst = self._annot_buf
+            
             # Detect bottles
             bottles_detected, detections, annotated_image = self.bottle_detector.detect_bottles(
-                image, return_image=True
+                image, return_image=True, dst=dst
             )
             
             result = {
@@ -163,7 +198,7 @@ class EnhancedMedicationVerifier:
                 'detections': detections,
                 'annotated_image': annotated_image,
                 'barcode_verified': False,
-                'bottle_positions': self.bottle_detector.get_bottle_positions(image)
+                'bottle_positions': self.bottle_detector.get_bottle_positions(detections=detections)
             }
             
             # Barcode scanning if enabled and available
@@ -192,13 +227,8 @@ class EnhancedMedicationVerifier:
     
     def _verify_barcodes(self, barcodes: List, expected_medication_id: int) -> bool:
         """Verify barcode matches expected medication"""
-        expected_barcode = f"MED_{expected_medication_id}"
-        
-        for barcode in barcodes:
-            if barcode['data'] == expected_barcode:
-                return True
-        
-        return False
+        expected = _expected_barcodes(expected_medication_id)
+        return any(barcode['data'] in expected for barcode in barcodes)
     
     def _create_error_result(self, message: str) -> Dict:
         """Create error result dictionary"""
@@ -206,7 +236,7 @@ class EnhancedMedicationVerifier:
             'success': False,
             'message': message,
             'detected_bottles': 0,
-            'detections': [],
+            'detections': np.empty((0, 6), dtype=np.float32),
             'barcode_verified': False,
             'detection_time': 0,
             'performance_metrics': self.get_performance_metrics()
@@ -224,18 +254,23 @@ class EnhancedMedicationVerifier:
             print("Real-time detection is already running")
             return
         
+        # The loop runs capture, inference and I/O on their own threads;
+        # keep OpenCV/PyTorch pools from oversubscribing the cores they need
+        ModelManager.configure_thread_budget()
+        
         self.is_running = True
         self.detection_callback = callback
         
         def detection_loop():
+            frame_interval = 1.0 / fps
+            next_deadline = time.monotonic()
+            
             while self.is_running:
-                start_time = time.time()
-                
                 # Capture image
                 image = self.camera.capture_image(timeout=1.0)
                 if image is not None:
-                    # Process image
-                    result = self._process_image(image)
+                    # Process image (annotated frame reuses one buffer across iterations)
+                    result = self._process_image(image, reuse_buffer=True)
                     
                     # Update performance metrics
                     self.total_detections += 1
@@ -248,10 +283,16 @@ class EnhancedMedicationVerifier:
                     
                     self.last_detection_result = result
                 
-                # Control frame rate
-                elapsed = time.time() - start_time
-                sleep_time = max(0, 1.0/fps - elapsed)
-                time.sleep(sleep_time)
+                # Control frame rate against a fixed monotonic schedule so
+                # processing jitter does not accumulate as drift
+                next_deadline += frame_interval
+                now = time.monotonic()
+                if now - next_deadline > frame_interval:
+                    # Fell more than a frame behind: resync and grab the next
+                    # frame immediately to keep the camera buffer drained
+                    next_deadline = now
+                    continue
+                time.sleep(max(0.0, next_deadline - now))
         
         self.detection_thread = threading.Thread(target=detection_loop)
         self.detection_thread.daemon = True
@@ -277,7 +318,7 @@ class EnhancedMedicationVerifier:
             'success_rate': success_rate,
             'average_detection_time': self.average_detection_time,
             'camera_info': self.camera.get_camera_info(),
-            'model_loaded': self.bottle_detector.model is not None,
+            'model_loaded': self.bottle_detector._get_model() is not None,
             'barcode_scanning_enabled': self.enable_barcode_scanning,
             'pyzbar_available': self.pyzbar_available
         }
@@ -299,16 +340,20 @@ class EnhancedMedicationVerifier:
             
             if 'annotated_image' in result and result['annotated_image'] is not None:
                 image_path = os.path.join(output_dir, f"detection_{timestamp}.jpg")
-                cv2.imwrite(image_path, result['annotated_image'])
-                result['saved_image_path'] = image_path
+                ok, buf = cv2.imencode('.jpg', result['annotated_image'], [cv2.IMWRITE_JPEG_QUALITY, 85])
+                if ok:
+                    self._io_pool.submit(Path(image_path).write_bytes, buf.tobytes())
+                    result['saved_image_path'] = image_path
             
-            # Save detection data
+            # Save detection data (the annotated image is already on disk as JPEG)
             json_path = os.path.join(output_dir, f"detection_{timestamp}.json")
-            import json
-            with open(json_path, 'w') as f:
-                # Convert numpy arrays to lists for JSON serialization
-                serializable_result = self._make_json_serializable(result)
-                json.dump(serializable_result, f, indent=2)
+            data = {k: v for k, v in result.items() if k != 'annotated_image'}
+            if orjson is not None:
+                with open(json_path, 'wb') as f:
+                    f.write(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
+            else:
+                with open(json_path, 'w') as f:
+                    json.dump(data, f, indent=2, default=self._json_default)
             
             return True
             
@@ -316,18 +361,14 @@ class EnhancedMedicationVerifier:
             print(f"Failed to save detection result: {e}")
             return False
     
-    def _make_json_serializable(self, obj):
-        """Convert numpy arrays and other non-serializable objects to JSON-friendly format"""
+    @staticmethod
+    def _json_default(obj):
+        """json.dump fallback for numpy values when orjson is not installed"""
         if isinstance(obj, np.ndarray):
             return obj.tolist()
-        elif isinstance(obj, dict):
-            return {k: self._make_json_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [self._make_json_serializable(item) for item in obj]
-        elif isinstance(obj, tuple):
-            return tuple(self._make_json_serializable(item) for item in obj)
-        else:
-            return obj
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
     
     def get_camera_preview(self, callback: callable = None, fps: int = 30) -> bool:
         """
@@ -410,6 +451,7 @@ class EnhancedMedicationVerifier:
         self.stop_realtime_detection()
         self.stop_camera_preview()
         self.camera.release()
+        self._io_pool.shutdown(wait=True)
         print("Enhanced medication verifier cleaned up")
     
     def __del__(self):
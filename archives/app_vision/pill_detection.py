@@ -6,56 +6,427 @@ import cv2
 import numpy as np
 from PIL import Image
 import os
+import json
+import hashlib
+import threading
+from app.vision.model_manager import ModelManager
+
+# YOLOv5 weights and the TensorRT engine exported from them. The engine is
+# static (batch 1, ENGINE_IMGSZ square) and named after that shape, so it
+# never collides with the dynamic-batch exports ModelManager builds
+WEIGHTS_PATH = 'yolov5s.pt'
+ENGINE_IMGSZ = 640
+ENGINE_PATH = f'yolov5s_b1_{ENGINE_IMGSZ}.engine'
+# OpenVINO IR directory used on CPU-only hosts
+OPENVINO_PATH = 'yolov5s_openvino_model/'
+
+# Traced TorchScript copies of the weights, keyed by a hash of the .pt file
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'medguardian')
+SCRIPT_IMGSZ = 640
+
+# FP16 inference on CUDA (Tensor Cores); CPU stays FP32
+USE_HALF = torch is not None and torch.cuda.is_available()
+
+
+def _opencv_cuda_available():
+    """True when OpenCV was built with CUDA and a device is present"""
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+# Image preprocessing runs on the GPU through cv2.cuda when possible
+USE_CV_CUDA = _opencv_cuda_available()
+LETTERBOX_COLOR = (114, 114, 114)
+
+
+def _letterbox_warp(image, imgsz):
+    """
+    Letterbox (resize + pad) in a single warpAffine instead of resize followed
+    by copyMakeBorder. Runs on the GPU via cv2.cuda when available.
+    Returns (boxed_image, ratio, (pad_left, pad_top)).
+    """
+    h, w = image.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    nw, nh = int(round(w * r)), int(round(h * r))
+    left, top = (imgsz - nw) // 2, (imgsz - nh) // 2
+    
+    # Same pixel-centre mapping as cv2.resize, shifted by the padding
+    shift = 0.5 * r - 0.5
+    M = np.array([[r, 0, left + shift], [0, r, top + shift]], dtype=np.float32)
+    
+    if USE_CV_CUDA:
+        gpu = cv2.cuda_GpuMat()
+        gpu.upload(image)
+        boxed = cv2.cuda.warpAffine(gpu, M, (imgsz, imgsz), flags=cv2.INTER_LINEAR,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=LETTERBOX_COLOR).download()
+    else:
+        boxed = cv2.warpAffine(image, M, (imgsz, imgsz), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_CONSTANT, borderValue=LETTERBOX_COLOR)
+    return boxed, r, (left, top)
+
+
+def _binarize(image, thresh=60):
+    """Grayscale -> 5x5 Gaussian blur -> binary threshold, on the GPU when available"""
+    if USE_CV_CUDA:
+        gpu = cv2.cuda_GpuMat()
+        gpu.upload(image)
+        gray = cv2.cuda.cvtColor(gpu, cv2.COLOR_BGR2GRAY)
+        blur = cv2.cuda.createGaussianFilter(cv2.CV_8UC1, cv2.CV_8UC1, (5, 5), 0)
+        _, binary = cv2.cuda.threshold(blur.apply(gray), thresh, 255, cv2.THRESH_BINARY)
+        return binary.download()
+    
+    # Convert to grayscale
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    
+    # Apply Gaussian blur
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+    
+    # Apply threshold
+    _, binary = cv2.threshold(blurred, thresh, 255, cv2.THRESH_BINARY)
+    return binary
+
+
+def _export_trt_engine(weights_path=WEIGHTS_PATH, engine_path=ENGINE_PATH):
+    """
+    Build an FP16 batch-1 TensorRT engine from the YOLOv5 weights using the
+    exporter shipped in the cached torch.hub repo, saved as engine_path.
+    Returns the engine path or None.
+    """
+    try:
+        import sys
+        import tensorrt  # noqa: F401 - only checking the runtime is installed
+        
+        repo_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+        if repo_dir not in sys.path:
+            sys.path.insert(0, repo_dir)
+        import export as yolov5_export
+        
+        yolov5_export.run(weights=weights_path, include=('engine',), half=True, device='0',
+                          imgsz=(ENGINE_IMGSZ, ENGINE_IMGSZ), batch_size=1)
+        # The exporter always writes <weights>.engine; move it to its shape-specific name
+        exported = os.path.splitext(weights_path)[0] + '.engine'
+        if not os.path.exists(exported):
+            return None
+        os.replace(exported, engine_path)
+        return engine_path
+    except Exception as e:
+        print(f"TensorRT export unavailable: {e}")
+        return None
+
+
+def _export_openvino(weights_path=WEIGHTS_PATH):
+    """
+    Convert the YOLOv5 weights to OpenVINO IR for CPU inference using the
+    exporter shipped in the cached torch.hub repo. Returns the model dir or None.
+    """
+    try:
+        import sys
+        import openvino  # noqa: F401 - only checking the runtime is installed
+        
+        repo_dir = os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+        if repo_dir not in sys.path:
+            sys.path.insert(0, repo_dir)
+        import export as yolov5_export
+        
+        yolov5_export.run(weights=weights_path, include=('openvino',), device='cpu')
+        model_dir = os.path.splitext(weights_path)[0] + '_openvino_model/'
+        return model_dir if os.path.isdir(model_dir) else None
+    except Exception as e:
+        print(f"OpenVINO export unavailable: {e}")
+        return None
+
+
+def _torchscript_path(weights_path=WEIGHTS_PATH):
+    """Cache path for the traced network, or None if the weights aren't on disk"""
+    if not os.path.exists(weights_path):
+        return None
+    digest = hashlib.sha1()
+    with open(weights_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    return os.path.join(CACHE_DIR, f"{stem}-{digest.hexdigest()[:12]}.torchscript")
+
+
+class _PredictionHead(torch.nn.Module if torch is not None else object):
+    """Expose only the raw prediction tensor of a YOLOv5 DetectionModel (traceable)"""
+    
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+    
+    def forward(self, x):
+        y = self.net(x)
+        return y[0] if isinstance(y, (list, tuple)) else y
+
+
+def _compile_head(head, device):
+    """
+    channels_last + torch.compile for the eager prediction head on CUDA.
+    Warmed up at load time; falls back to the eager head if compilation
+    fails or torch < 2.0.
+    """
+    if device.type != 'cuda':
+        return head
+    head = head.to(memory_format=torch.channels_last)
+    if not hasattr(torch, 'compile'):
+        return head
+    try:
+        compiled = torch.compile(head, mode='reduce-overhead')
+        dtype = torch.float16 if USE_HALF else torch.float32
+        example = torch.zeros(1, 3, SCRIPT_IMGSZ, SCRIPT_IMGSZ, device=device, dtype=dtype)
+        with torch.inference_mode():
+            compiled(example.contiguous(memory_format=torch.channels_last))
+        return compiled
+    except Exception as e:
+        print(f"torch.compile unavailable for YOLOv5, using eager mode: {e}")
+        return head
+
+
+def _save_torchscript(model, script_path):
+    """Trace the network inside a hub-loaded model and persist it with its class names"""
+    try:
+        device = next(model.parameters()).device
+        head = _PredictionHead(model.model.model).eval()
+        example = torch.zeros(1, 3, SCRIPT_IMGSZ, SCRIPT_IMGSZ, device=device)
+        with torch.inference_mode():
+            scripted = torch.jit.trace(head, example, strict=False)
+        
+        names = model.names if isinstance(model.names, dict) else dict(enumerate(model.names))
+        os.makedirs(os.path.dirname(script_path), exist_ok=True)
+        torch.jit.save(scripted, script_path,
+                       _extra_files={'names.json': json.dumps({str(k): v for k, v in names.items()})})
+        print(f"Cached traced YOLOv5 model at {script_path}")
+    except Exception as e:
+        print(f"TorchScript caching skipped: {e}")
+
+
+class _Results:
+    """Subset of YOLOv5's Detections object used by PillDetector"""
+    
+    def __init__(self, xyxy):
+        self.xyxy = xyxy
+
+
+class _ScriptedYolo:
+    """
+    Minimal stand-in for YOLOv5's AutoShape around a traced network:
+    letterbox -> forward -> confidence filter -> per-class NMS -> rescale.
+    Returns results with the same .xyxy[i] (N, 6) layout as the hub model.
+    """
+    conf = 0.25
+    iou = 0.45
+    
+    def __init__(self, module, names, device, imgsz=SCRIPT_IMGSZ):
+        self.module = module
+        self.names = names
+        self.device = device
+        self.imgsz = imgsz
+        self.dtype = torch.float16 if device.type == 'cuda' else torch.float32
+    
+    def _postprocess(self, pred, ratio, pad, shape):
+        # Class confidence is objectness * class score <= objectness, so gating on
+        # objectness while still on the device drops most rows before the host copy
+        pred = pred[pred[:, 4] > self.conf]
+        if not len(pred):
+            return torch.zeros((0, 6))
+        pred = pred.float().cpu().numpy()
+        cls_scores = pred[:, 5:] * pred[:, 4:5]
+        cls_ids = cls_scores.argmax(1)
+        conf = cls_scores[np.arange(len(pred)), cls_ids]
+        keep = conf > self.conf
+        if not keep.any():
+            return torch.zeros((0, 6))
+        
+        xywh, conf, cls_ids = pred[keep, :4], conf[keep], cls_ids[keep]
+        # Offset boxes per class so one NMS call never suppresses across classes
+        offset = cls_ids[:, None] * 4096.0
+        nms_boxes = np.column_stack([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, 2:]])
+        nms_boxes[:, :2] += offset
+        idx = np.array(cv2.dnn.NMSBoxes(nms_boxes.tolist(), conf.tolist(), self.conf, self.iou)).reshape(-1)
+        
+        xyxy = np.column_stack([xywh[idx, :2] - xywh[idx, 2:] / 2, xywh[idx, :2] + xywh[idx, 2:] / 2])
+        xyxy -= np.array([pad[0], pad[1], pad[0], pad[1]])
+        xyxy /= ratio
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, shape[1])
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, shape[0])
+        return torch.from_numpy(np.column_stack([xyxy, conf[idx], cls_ids[idx]]).astype(np.float32))
+    
+    def __call__(self, images):
+        images = images if isinstance(images, list) else [images]
+        boxed, meta = [], []
+        for image in images:
+            img, r, pad = _letterbox_warp(np.asarray(image), self.imgsz)
+            boxed.append(img)
+            meta.append((r, pad, image.shape[:2]))
+        
+        x = torch.from_numpy(np.stack(boxed)).to(self.device).permute(0, 3, 1, 2).to(self.dtype) / 255.0
+        x = x.contiguous(memory_format=torch.channels_last)  # NHWC source: no copy
+        with torch.inference_mode():
+            preds = self.module(x)
+        return _Results([self._postprocess(p, *m) for p, m in zip(preds, meta)])
+
+
+def _load_torchscript(script_path):
+    """Load a cached traced network without going through torch.hub"""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    extra = {'names.json': ''}
+    module = torch.jit.load(script_path, map_location=device, _extra_files=extra)
+    names = {int(k): v for k, v in json.loads(extra['names.json']).items()}
+    module = module.eval()
+    if USE_HALF:
+        module = module.half()
+    if device.type == 'cuda':
+        module = module.to(memory_format=torch.channels_last)
+    return _ScriptedYolo(module, names, device)
+
+
+def _load_model():
+    """Attempt to load YOLOv5 model, fallback to None if unavailable"""
+    try:
+        if torch is None:
+            raise ImportError("PyTorch not available")
+        # Prefer a TensorRT FP16 engine on GPU; YOLOv5's hub loader runs
+        # .engine files through the same AutoShape API (results.xyxy)
+        if torch.cuda.is_available():
+            engine_path = ENGINE_PATH if os.path.exists(ENGINE_PATH) else _export_trt_engine()
+            if engine_path:
+                try:
+                    return torch.hub.load('ultralytics/yolov5', 'custom', path=engine_path)
+                except Exception as e:
+                    print(f"TensorRT engine load failed, using PyTorch weights: {e}")
+        else:
+            # CPU-only host: OpenVINO IR through the same hub loader is
+            # several times faster than eager PyTorch on CPU
+            openvino_path = OPENVINO_PATH if os.path.isdir(OPENVINO_PATH) else _export_openvino()
+            if openvino_path:
+                try:
+                    return torch.hub.load('ultralytics/yolov5', 'custom', path=openvino_path)
+                except Exception as e:
+                    print(f"OpenVINO model load failed, using PyTorch weights: {e}")
+        
+        # Reuse a traced copy of these exact weights if one is cached,
+        # skipping the hub repo import and graph construction entirely
+        script_path = _torchscript_path()
+        if script_path and os.path.exists(script_path):
+            try:
+                return _load_torchscript(script_path)
+            except Exception as e:
+                print(f"Cached TorchScript model unusable, reloading from hub: {e}")
+        
+        # Try loading YOLOv5 model with error handling
+        model = torch.hub.load('ultralytics/yolov5', 'custom', path=WEIGHTS_PATH)
+        script_path = script_path or _torchscript_path()
+        if script_path:
+            _save_torchscript(model, script_path)
+        
+        # Run the raw network through our own post-processing instead of
+        # AutoShape, so predictions are confidence-gated before leaving the GPU
+        device = next(model.parameters()).device
+        names = model.names if isinstance(model.names, dict) else dict(enumerate(model.names))
+        head = _PredictionHead(model.model.model).eval()
+        if USE_HALF:
+            head = head.half()
+        return _ScriptedYolo(_compile_head(head, device), names, device)
+    except Exception as e:
+        print(f"YOLOv5 model loading failed: {e}")
+        print("Using fallback detection method")
+        return None
+
+
+# Process-wide model (see get_pill_model); None until a load succeeds
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_pill_model():
+    """
+    Process-wide YOLOv5 model shared by every PillDetector.
+    Loaded on first use; the hub/TensorRT/TorchScript setup and CUDA
+    context are created once per process instead of once per detector.
+    The first load also applies ModelManager's thread budget, so OpenCV
+    doesn't fan every fallback threshold/contour call out over all cores.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                ModelManager.configure_thread_budget()
+                # Only a successful load is kept; after a failure the next
+                # detector retries instead of staying on the fallback for good
+                _model = _load_model()
+    return _model
+
+
+def clear_pill_model():
+    """Drop the cached model so the next get_pill_model() reloads it (hot-reload)"""
+    global _model
+    with _model_lock:
+        _model = None
+
 
 class PillDetector:
     def __init__(self):
         """Initialize the pill detector with fallback to basic image processing"""
-        self.model = self._load_model()
+        self.model = get_pill_model()
         self.confidence_threshold = 0.5
-    
-    def _load_model(self):
-        """Attempt to load YOLOv5 model, fallback to None if unavailable"""
-        try:
-            if torch is None:
-                raise ImportError("PyTorch not available")
-            # Try loading YOLOv5 model with error handling
-            self.model = torch.hub.load('ultralytics/yolov5', 'custom', path='yolov5s.pt')
-            return self.model
-        except Exception as e:
-            print(f"YOLOv5 model loading failed: {e}")
-            print("Using fallback detection method")
-            return None
+        self.use_half = USE_HALF  # False on CPU: plain FP32 inference
     
     def detect_pills(self, image):
         """
         Detect pills/bottles in the given image
-        Returns: list of bounding boxes in format [x1, y1, x2, y2, confidence, class]
+        Returns: (N, 6) float32 array of [x1, y1, x2, y2, confidence, class] rows
         """
         if self.model is not None:
             return self._yolo_detection(image)
         else:
             return self._fallback_detection(image)
     
+    def detect_pills_batch(self, images):
+        """
+        Detect pills/bottles in several frames with a single forward pass
+        (e.g. a whole stability window). Returns one (N, 6) detections array per image.
+        """
+        if not images:
+            return []
+        if self.model is not None:
+            return self._yolo_detection_batch(images)
+        return [self._fallback_detection(image) for image in images]
+    
     def _yolo_detection(self, image):
         """Use YOLOv5 model for detection"""
+        return self._yolo_detection_batch([image])[0]
+    
+    def _yolo_detection_batch(self, images):
+        """Use YOLOv5 model for detection on a batch of images"""
+        # Convert PIL Images to numpy arrays if needed
+        images = [np.asarray(image) if isinstance(image, Image.Image) else image for image in images]
         try:
-            # Convert PIL Image to numpy array if needed
-            if isinstance(image, Image.Image):
-                image = np.array(image)
-            
-            # Run inference
-            results = self.model(image)
-            
-            # Extract detections
-            detections = results.xyxy[0].cpu().numpy()
+            # Run inference (FP16 autocast on CUDA, no autograd bookkeeping)
+            with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.float16,
+                                                        enabled=self.use_half):
+                if isinstance(self.model, _ScriptedYolo):
+                    batch_xyxy = self.model(images).xyxy
+                else:
+                    # TensorRT engine / OpenVINO IR are exported at batch 1:
+                    # feed them one frame at a time
+                    batch_xyxy = [self.model(image).xyxy[0] for image in images]
             
-            # Filter by confidence
-            detections = detections[detections[:, 4] > self.confidence_threshold]
+            batch_detections = []
+            for xyxy in batch_xyxy:
+                # Extract detections
+                detections = xyxy.cpu().numpy()
+                
+                # Filter by confidence
+                detections = detections[detections[:, 4] > self.confidence_threshold]
+                batch_detections.append(detections.astype(np.float32, copy=False))
             
-            return detections.tolist()
+            return batch_detections
         except Exception as e:
             print(f"YOLO detection error: {e}")
-            return self._fallback_detection(image)
+            return [self._fallback_detection(image) for image in images]
     
     def _fallback_detection(self, image):
         """
@@ -64,34 +435,33 @@ class PillDetector:
         """
         # Convert PIL Image to numpy array if needed
         if isinstance(image, Image.Image):
-            image = np.array(image)
+            image = np.asarray(image)
         
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Grayscale, blur and threshold (GPU when OpenCV has CUDA)
+        thresh = _binarize(image)
         
-        # Apply Gaussian blur
-        blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+        # Label blobs; stats rows are [x, y, w, h, area] with row 0 the background
+        num, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8, ltype=cv2.CV_32S)
+        if num <= 1:
+            return self._empty_detections()
         
-        # Apply threshold
-        _, thresh = cv2.threshold(blurred, 60, 255, cv2.THRESH_BINARY)
+        x, y, w, h = stats[1:, 0], stats[1:, 1], stats[1:, 2], stats[1:, 3]
         
-        # Find contours
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # Filter small objects and aspect ratios
+        keep = (w > 30) & (h > 30) & (w > h * 0.5) & (w < h * 2)
+        n = int(keep.sum())
         
-        detections = []
-        for contour in contours:
-            # Get bounding box
-            x, y, w, h = cv2.boundingRect(contour)
-            
-            # Filter small objects and aspect ratios
-            if w > 30 and h > 30 and w > h * 0.5 and w < h * 2:
-                # Convert to [x1, y1, x2, y2, confidence, class] format
-                x1, y1, x2, y2 = x, y, x + w, y + h
-                confidence = 0.7  # Fixed confidence for fallback
-                class_id = 0     # Fixed class for fallback
-                detections.append([x1, y1, x2, y2, confidence, class_id])
-        
-        return detections
+        # [x1, y1, x2, y2, confidence, class] with fixed fallback confidence/class
+        detections = np.column_stack([
+            x[keep], y[keep], x[keep] + w[keep], y[keep] + h[keep],
+            np.full(n, 0.7), np.zeros(n)
+        ])
+        return detections.astype(np.float32)
+    
+    @staticmethod
+    def _empty_detections():
+        """Empty (0, 6) detections array"""
+        return np.empty((0, 6), dtype=np.float32)
     
     def verify_medication(self, image):
         """
@@ -102,27 +472,47 @@ class PillDetector:
         bottles_detected = len(detections) > 0
         return bottles_detected, detections
     
-    def draw_detections(self, image, detections):
+    def verify_medication_batch(self, images):
+        """
+        Batched verify_medication for a window of frames
+        Returns: list of (bottles_detected, detections)
+        """
+        return [(len(detections) > 0, detections) for detections in self.detect_pills_batch(images)]
+    
+    def draw_detections(self, image, detections, inplace=False):
         """
         Draw bounding boxes on the image
+        inplace: draw directly onto a numpy input instead of a copy
         Returns: annotated image
         """
-        # Convert PIL Image to numpy array if needed
+        # Convert PIL Image to numpy array if needed (PIL buffers are read-only,
+        # so this one always copies)
         if isinstance(image, Image.Image):
             img = np.array(image)
+        elif inplace:
+            img = image
         else:
             img = image.copy()
         
-        # Draw each detection
-        for detection in detections:
-            x1, y1, x2, y2, confidence, class_id = map(int, detection[:6])
-            
-            # Draw rectangle
-            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            
-            # Draw label
+        # Integer box corners in one cast; confidences stay float for the label
+        d = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+        if not len(d):
+            return img
+        boxes = d[:, :4].astype(np.int32)
+        
+        # All rectangles in one call: (N, 4, 2) corner polygons
+        x1, y1, x2, y2 = boxes.T
+        corners = np.stack([
+            np.column_stack([x1, y1]), np.column_stack([x2, y1]),
+            np.column_stack([x2, y2]), np.column_stack([x1, y2])
+        ], axis=1)
+        cv2.polylines(img, list(corners), isClosed=True, color=(0, 255, 0), thickness=2)
+        
+        # Labels still need one putText each
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for (x1, y1, _, _), confidence in zip(boxes.tolist(), d[:, 4].tolist()):
             label = f"Pill: {confidence:.2f}"
-            cv2.putText(img, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+            cv2.putText(img, label, (x1, y1 - 10), font, 0.5, (0, 255, 0), 2)
         
         return img
     
@@ -135,11 +525,8 @@ class PillDetector:
         count = len(detections)
         
         # Calculate total area covered
-        total_area = 0
-        for detection in detections:
-            x1, y1, x2, y2 = detection[:4]
-            area = (x2 - x1) * (y2 - y1)
-            total_area += area
+        d = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+        total_area = float(((d[:, 2] - d[:, 0]) * (d[:, 3] - d[:, 1])).sum())
         
         image_area = image.shape[0] * image.shape[1] if hasattr(image, 'shape') else 64000
         coverage_percentage = (total_area / image_area) * 100
@@ -9,13 +9,16 @@ if db_url and db_url.startswith('postgres://'):
 
 try:
     conn = psycopg2.connect(db_url)
-    cur = conn.cursor()
+    # Named (server-side) cursor streams rows in batches instead of fetching all at once
+    cur = conn.cursor(name='db_activity')
+    cur.itersize = 100
     
     print("Listing active connections...")
-    cur.execute("SELECT pid, state, query, wait_event_type, wait_event FROM pg_stat_activity WHERE datname = 'postgres' AND pid <> pg_backend_pid();")
-    rows = cur.fetchall()
-    for row in rows:
-        print(f"PID: {row[0]}, State: {row[1]}, Waiting: {row[3]}, Query: {row[2][:100]}")
+    # Truncate query text and drop idle sessions in SQL so less crosses the wire
+    cur.execute("SELECT pid, state, LEFT(query, 100), wait_event_type, wait_event FROM pg_stat_activity "
+                "WHERE datname = 'postgres' AND pid <> pg_backend_pid() AND state <> 'idle';")
+    for row in cur:
+        print(f"PID: {row[0]}, State: {row[1]}, Waiting: {row[3]}, Query: {row[2]}")
     
     cur.close()
     conn.close()
@@ -1,5 +1,5 @@
 from app import create_app, db
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text
 from app.models.auth import User
 from app.models.medication import Medication
 from app.models.medication_log import MedicationLog
@@ -7,8 +7,6 @@ from app.models.relationship import CaregiverSenior
 
 app = create_app()
 with app.app_context():
-    inspector = inspect(db.engine)
-    
     models = {
         'user': User,
         'medication': Medication,
@@ -16,8 +14,26 @@ with app.app_context():
         'caregiver_senior': CaregiverSenior
     }
     
+    columns_by_table = {}
+    if db.engine.dialect.name == 'postgresql':
+        # One information_schema query for every table instead of one per table
+        rows = db.session.execute(
+            text("SELECT table_name, column_name FROM information_schema.columns "
+                 "WHERE table_schema = current_schema() AND table_name = ANY(:tables)"),
+            {'tables': list(models)}
+        ).fetchall()
+        for table_name, column_name in rows:
+            columns_by_table.setdefault(table_name, set()).add(column_name)
+    else:
+        # SQLite (the default database) has no information_schema
+        inspector = inspect(db.engine)
+        existing = set(inspector.get_table_names())
+        for table_name in models:
+            if table_name in existing:
+                columns_by_table[table_name] = {col['name'] for col in inspector.get_columns(table_name)}
+    
     for table_name, model in models.items():
-        db_cols = set(col['name'] for col in inspector.get_columns(table_name))
+        db_cols = columns_by_table.get(table_name, set())
         model_cols = set(c.key for c in model.__table__.columns)
         
         missing_in_db = model_cols - db_cols
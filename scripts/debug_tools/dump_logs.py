@@ -1,4 +1,4 @@
-from app import create_app
+from app import create_app, db
 from app.models.medication_log import MedicationLog
 from app.models.auth import User
 from app.models.medication import Medication
@@ -20,8 +20,12 @@ with app.app_context():
             print(f"  Schedule: {times}")
             print(f"  Created: {m.created_at}")
         
-        logs = MedicationLog.query.filter_by(user_id=senior.id).all()
-        print(f"\nTotal Logs: {len(logs)}")
-        for l in logs:
-            med_name = l.medication.name if l.medication else "Unknown"
-            print(f"- {l.taken_at} | {med_name} | Correct: {l.taken_correctly}")
+        # One JOIN for the medication names (no per-log relationship load),
+        # streamed in chunks instead of materializing every row
+        logs = (db.session.query(MedicationLog, Medication.name)
+                .join(Medication, MedicationLog.medication_id == Medication.id, isouter=True)
+                .filter(MedicationLog.user_id == senior.id)
+                .yield_per(500))
+        print(f"\nTotal Logs: {MedicationLog.query.filter_by(user_id=senior.id).count()}")
+        for l, med_name in logs:
+            print(f"- {l.taken_at} | {med_name or 'Unknown'} | Correct: {l.taken_correctly}")
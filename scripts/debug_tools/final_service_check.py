@@ -1,5 +1,6 @@
 import sys
 import os
+import importlib
 
 # Add project root to path
 sys.path.append(os.path.abspath(os.curdir))
@@ -12,7 +13,21 @@ from app.models.auth import User
 from app.models.medication import Medication
 from app.extensions import db
 
+# Heavy modules imported up front in one pass, so import time is paid once
+# before the audits instead of inside the first one that touches them
+PRELOAD_MODULES = ['app.vision.vision_v2']
+
+def preload_modules():
+    errors = {}
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            errors[name] = e
+    return errors
+
 def final_audit():
+    preload_errors = preload_modules()
     app = create_app()
     with app.app_context():
         print("🔍 RUNNING FINAL AI SERVICE AUDIT...")
@@ -45,8 +60,10 @@ def final_audit():
             print(f"❌ Analytics Service Failure: {e}")
 
         print("\n--- [Audit 4: Vision Engine] ---")
-        from app.vision.vision_v2 import vision_v2
         try:
+            if 'app.vision.vision_v2' in preload_errors:
+                raise preload_errors['app.vision.vision_v2']
+            from app.vision.vision_v2 import vision_v2
             # Check models exist (YOLO, etc)
             print(f"✅ Vision V2 Engine Initialized: {vision_v2 is not None}")
         except Exception as e:
@@ -1,11 +1,13 @@
 from app import create_app
 from app.extensions import db
-from app.models.medication import Medication, MedicationLog
+from app.models.medication import Medication
+from app.models.medication_log import MedicationLog
 
 app = create_app()
 
 with app.app_context():
-    num_logs = MedicationLog.query.delete()
-    num_meds = Medication.query.delete()
+    # Table-level DELETEs: no ORM objects are loaded for either table
+    num_logs = db.session.execute(MedicationLog.__table__.delete()).rowcount
+    num_meds = db.session.execute(Medication.__table__.delete()).rowcount
     db.session.commit()
     print(f"🧹 Database cleaned: Deleted {num_meds} medications and {num_logs} logs.")
@@ -0,0 +1,85 @@
+"""
+Reference bank tests: a bank row must stay aligned with its reference angle
+even when some references fail to load or extract.
+"""
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.vision import feature_extractor as fe
+
+rng = np.random.default_rng(0)
+FEATURES = {name: rng.random(64).astype(np.float32) for name in ('front', 'side', 'back')}
+
+
+@pytest.fixture(autouse=True)
+def fake_extractor(monkeypatch):
+    """Features keyed by reference name (base64) or by the frame's first pixel (images)"""
+    monkeypatch.setattr(fe, 'extract_features_from_base64', lambda ref: FEATURES.get(ref))
+    by_pixel = {i: FEATURES[name] for i, name in enumerate(FEATURES, start=1)}
+    monkeypatch.setattr(fe, 'extract_features', lambda image: by_pixel.get(int(image[0, 0, 0])))
+    fe._reference_bank_cache.clear()
+
+
+def _frame(index):
+    """Image whose features are the index-th entry of FEATURES (1-based)"""
+    return np.full((8, 8, 3), index, dtype=np.uint8)
+
+
+def test_failed_reference_keeps_its_row():
+    bank = fe.build_reference_bank(json.dumps(['front', 'unreadable', 'back']))
+    assert bank.shape == (3, 64)
+    assert np.isnan(bank[1]).all()
+    assert not np.isnan(bank[[0, 2]]).any()
+
+
+@pytest.mark.parametrize('source', ['json', 'bank', 'npy'])
+def test_best_index_is_the_reference_angle(tmp_path, source):
+    references = json.dumps(['front', 'unreadable', 'back'])
+    if source == 'bank':
+        references = fe.build_reference_bank(references)
+    elif source == 'npy':
+        references = str(tmp_path / 'bank.npy')
+        fe.build_reference_bank(json.dumps(['front', 'unreadable', 'back']), bank_path=references)
+
+    score, index = fe.compare_to_references(_frame(3), references)  # live frame is 'back'
+    assert index == 2
+    assert score == pytest.approx(1.0, abs=1e-3)
+
+    score, index = fe.compare_to_references(_frame(1), references)  # live frame is 'front'
+    assert index == 0
+    assert score == pytest.approx(1.0, abs=1e-3)
+
+
+def test_files_bank_skips_unreadable_middle_reference(tmp_path):
+    paths = [str(tmp_path / 'front.png'), str(tmp_path / 'missing.png'), str(tmp_path / 'back.png')]
+    cv2.imwrite(paths[0], _frame(1))
+    cv2.imwrite(paths[2], _frame(3))
+
+    bank = fe.build_reference_bank_from_files(paths)
+    assert bank.shape == (3, 64) and np.isnan(bank[1]).all()
+
+    score, index = fe.compare_to_references(_frame(3), paths)
+    assert (index, score) == (2, pytest.approx(1.0, abs=1e-3))
+
+
+def test_all_references_failed():
+    assert fe.build_reference_bank(json.dumps(['unreadable', 'unreadable'])) is None
+    assert fe.compare_to_references(_frame(1), json.dumps(['unreadable'])) == (0.0, -1)
+
+
+def test_async_handle_is_none_only_on_failure(monkeypatch):
+    monkeypatch.setattr(fe, '_device', fe.torch.device('cpu'))
+
+    pending = fe.extract_features_async(_frame(2))
+    assert pending is not None
+    assert np.array_equal(fe.collect_features(pending), FEATURES['side'])
+
+    assert fe.extract_features_async(_frame(9)) is None  # extraction fails
+    assert fe.collect_features(None) is None
@@ -0,0 +1,404 @@
+"""
+Equivalence tests for the VisionEngineV2 fast paths against the OpenCV /
+per-medication code they replaced.
+"""
+import base64
+import importlib
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.setdefault('VISION_DISABLED', 'true')  # no background model loading on import
+
+# The package re-exports the singleton under the module's name
+vision_module = importlib.import_module('app.vision.vision_v2')
+VisionEngineV2 = vision_module.VisionEngineV2
+
+
+def _data_url(img):
+    ok, buf = cv2.imencode('.jpg', img)
+    assert ok
+    return 'data:image/jpeg;base64,' + base64.b64encode(buf.tobytes()).decode('ascii')
+
+
+# ---------------------------------------------------------------------------
+# Detector vocabularies
+# ---------------------------------------------------------------------------
+
+class _FakeWorldModel:
+    """
+    Stand-in for a YOLO-World model: every box has a score per text prompt,
+    and like YOLO-World's NMS only its highest-scoring class in the loaded
+    vocabulary survives.
+    """
+
+    def __init__(self, classes, scene):
+        self.names = dict(enumerate(classes))
+        self.scene = scene
+
+    def predict(self, imgs, conf, verbose=False):
+        if not isinstance(imgs, list):
+            imgs = [imgs]
+        classes = list(self.names.values())
+        boxes = []
+        for xyxy, scores in self.scene:
+            known = {label: s for label, s in scores.items() if label in classes}
+            if not known:
+                continue
+            label = max(known, key=known.get)
+            if known[label] < conf:
+                continue
+            boxes.append(SimpleNamespace(xyxy=np.array([xyxy], dtype=np.float32),
+                                         conf=np.array([known[label]]),
+                                         cls=np.array([classes.index(label)])))
+        return [SimpleNamespace(boxes=boxes) for _ in imgs]
+
+
+# A bottle the wider vocabulary would call "bottle", and a hand holding a strip
+SCENE = [
+    ((10, 10, 60, 90), {'medicine bottle': 0.72, 'pill bottle': 0.78, 'bottle': 0.81}),
+    ((70, 20, 110, 70), {'human hand': 0.60, 'hand': 0.55, 'pill strip': 0.65}),
+]
+
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)  # detect_hand writes debug_frames/
+    monkeypatch.setattr(vision_module, 'torch',
+                        SimpleNamespace(cuda=SimpleNamespace(is_available=lambda: False)), raising=False)
+    monkeypatch.setattr(vision_module, '_load_world_detector',
+                        lambda classes, device: (_FakeWorldModel(classes, SCENE), False))
+    eng = VisionEngineV2()
+    eng._load_models()
+    eng.vision_available = True
+    assert eng.models_loaded
+    return eng
+
+
+def test_detectors_keep_separate_vocabularies(engine):
+    assert list(engine.detector.names.values()) == VisionEngineV2.MEDICINE_CLASSES
+    assert list(engine.hand_detector.names.values()) == VisionEngineV2.HAND_CLASSES
+
+
+def test_cuda_graphs_captured_on_replay_thread(monkeypatch):
+    threads = {}
+
+    class _Model(_FakeWorldModel):
+        def predict(self, imgs, conf, verbose=False):
+            threads['predict'] = threading.get_ident()
+            return super().predict(imgs, conf, verbose)
+
+    monkeypatch.setattr(vision_module, '_enable_cuda_graphs',
+                        lambda model: threads.setdefault('capture', threading.get_ident()))
+    batcher = vision_module._BatchedPredictor(_Model(VisionEngineV2.MEDICINE_CLASSES, SCENE), conf=0.3,
+                                              cuda_graphs=True)
+    assert batcher.ready.wait(5)
+    batcher.predict(np.zeros((8, 8, 3), dtype=np.uint8))
+
+    assert threads['capture'] == threads['predict'] != threading.get_ident()
+
+
+def test_detection_matches_per_vocabulary_models(engine):
+    img = np.zeros((120, 120, 3), dtype=np.uint8)
+
+    # Baseline: one model per vocabulary, called directly
+    medicine = _FakeWorldModel(VisionEngineV2.MEDICINE_CLASSES, SCENE).predict(img, conf=0.3)[0]
+    hand = _FakeWorldModel(VisionEngineV2.HAND_CLASSES, SCENE).predict(img, conf=0.35)[0]
+    expected_labels = [VisionEngineV2.MEDICINE_CLASSES[int(b.cls[0])] for b in medicine.boxes]
+    expected_hand_conf = max(float(b.conf[0]) for b in hand.boxes)
+
+    result = engine.process_frame(_data_url(img))
+    assert [d['label'] for d in result['detections']] == expected_labels == ['medicine bottle', 'pill strip']
+    assert result['layer1_detection'] is True
+
+    hand_result = engine.detect_hand(_data_url(img))
+    assert hand_result['hand_detected'] is True
+    assert hand_result['confidence'] == pytest.approx(expected_hand_conf)
+    assert 'human hand (60.00%)' in hand_result['debug_detections']
+
+
+# ---------------------------------------------------------------------------
+# ORB match counting
+# ---------------------------------------------------------------------------
+
+def _bf_cross_check_count(des1, des2, max_distance):
+    """The BFMatcher path count_good_matches replaced"""
+    if len(des1) == 0 or len(des2) == 0:
+        return 0
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(des1, des2)
+    return len([m for m in matches if m.distance < max_distance])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_count_good_matches_equals_bf_cross_check(seed):
+    rng = np.random.default_rng(seed)
+    des2 = rng.integers(0, 256, (300, 32), dtype=np.uint8)
+    # Noisy copies of some live descriptors, so there are real matches
+    des1 = des2[rng.choice(300, 200, replace=False)].copy()
+    flips = rng.integers(0, 256, des1.shape, dtype=np.uint8) & rng.integers(0, 256, des1.shape, dtype=np.uint8)
+    des1[::2] ^= flips[::2] & 0x11
+    des1 = np.vstack([des1, rng.integers(0, 256, (100, 32), dtype=np.uint8)])
+
+    for max_distance in (40, 64, 256):
+        assert vision_module.count_good_matches(des1, des2, max_distance) == \
+            _bf_cross_check_count(des1, des2, max_distance)
+
+
+def test_count_good_matches_ties():
+    rng = np.random.default_rng(7)
+    base = rng.integers(0, 256, (50, 32), dtype=np.uint8)
+    # Every descriptor appears twice on both sides: all nearest neighbours tie
+    des1 = np.vstack([base, base])
+    des2 = np.vstack([base, base[::-1]])
+    assert vision_module.count_good_matches(des1, des2, 40) == _bf_cross_check_count(des1, des2, 40) > 0
+
+
+def test_count_good_matches_empty():
+    des = np.random.default_rng(0).integers(0, 256, (10, 32), dtype=np.uint8)
+    empty = np.empty((0, 32), np.uint8)
+    assert vision_module.count_good_matches(empty, des, 40) == 0
+    assert vision_module.count_good_matches(des, empty, 40) == 0
+    assert vision_module.count_good_matches(None, des, 40) == 0
+
+
+def test_hamming_distances_match_cv2_norm():
+    rng = np.random.default_rng(3)
+    a = rng.integers(0, 256, (20, 32), dtype=np.uint8)
+    b = rng.integers(0, 256, (30, 32), dtype=np.uint8)
+    expected = [[cv2.norm(x, y, cv2.NORM_HAMMING) for y in b] for x in a]
+    assert vision_module.hamming_distances(a, b).tolist() == expected
+
+
+# ---------------------------------------------------------------------------
+# Batched reference scoring
+# ---------------------------------------------------------------------------
+
+def _textured_frame(seed, size=(240, 320)):
+    rng = np.random.default_rng(seed)
+    img = cv2.GaussianBlur(rng.integers(0, 256, (*size, 3), dtype=np.uint8), (3, 3), 0)
+    cv2.rectangle(img, (40, 40), (140, 200), (30, 160, 220), -1)
+    cv2.putText(img, 'MEDS', (160, 120), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+    return img
+
+
+def _orb_fingerprint(des, profile=None):
+    payload = base64.b64encode(np.ascontiguousarray(des, dtype=np.uint8).tobytes()).decode('ascii')
+    if profile is None:
+        return payload  # legacy, untagged
+    return f"{vision_module.ORB_TAG}:{profile[0]}:{profile[1]}:{payload}"
+
+
+@pytest.fixture
+def scoring_setup():
+    eng = VisionEngineV2()
+    frame = _data_url(_textured_frame(0))
+    img = vision_module._decode_image(frame.split(',')[1])
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    rng = np.random.default_rng(1)
+
+    _, des_new = eng._orb_features(gray)
+    _, des_legacy = eng._orb_features(gray, vision_module.LEGACY_ORB_PROFILE)
+    noise = rng.integers(0, 256, (150, 32), dtype=np.uint8)
+    other = eng.get_histogram_fingerprint(_data_url(_textured_frame(2)))
+    same = eng.get_histogram_fingerprint(frame)
+
+    medications = [
+        SimpleNamespace(id=1, visual_fingerprint=_orb_fingerprint(des_new, eng.orb_profile),
+                        histogram_fingerprint=same),
+        # duplicated rows make every reverse argmin a tie
+        SimpleNamespace(id=2, visual_fingerprint=_orb_fingerprint(np.vstack([des_new, des_new]), eng.orb_profile),
+                        histogram_fingerprint=other),
+        SimpleNamespace(id=3, visual_fingerprint=_orb_fingerprint(np.vstack([des_new[::2], noise]), eng.orb_profile),
+                        histogram_fingerprint=None),
+        SimpleNamespace(id=4, visual_fingerprint=None, histogram_fingerprint=other),
+        SimpleNamespace(id=5, visual_fingerprint=_orb_fingerprint(des_legacy), histogram_fingerprint=None),
+        SimpleNamespace(id=6, visual_fingerprint=_orb_fingerprint(noise, eng.orb_profile),
+                        histogram_fingerprint=same),
+    ]
+    return eng, frame, img, gray, medications
+
+
+def _per_medication_scores(eng, img, gray, medications):
+    """Layer 2 / Layer 3 scores as process_frame computes them one medication at a time"""
+    live_hist = eng.compute_color_histogram(img)
+    counts, hists = [], []
+    for med in medications:
+        count = 0
+        if med.visual_fingerprint:
+            des = eng.decode_orb_fingerprint(med.visual_fingerprint)
+            _, des_live = eng._orb_features(gray, eng.orb_fingerprint_profile(med.visual_fingerprint))
+            count = vision_module.count_good_matches(des, des_live, 40)
+        counts.append(count)
+        score = 0.0
+        if med.histogram_fingerprint:
+            score = eng.compare_histograms(eng.decode_histogram_fingerprint(med.histogram_fingerprint), live_hist)
+        hists.append(score)
+    return np.array(counts), np.array(hists)
+
+
+@pytest.mark.parametrize('chunk_bytes', [vision_module.MATCH_CHUNK_BYTES, 1])
+def test_score_references_matches_per_medication_loop(scoring_setup, monkeypatch, chunk_bytes):
+    eng, frame, img, gray, medications = scoring_setup
+    monkeypatch.setattr(vision_module, 'MATCH_CHUNK_BYTES', chunk_bytes)
+
+    scores = eng.score_references(frame, eng.load_references(medications))
+    expected_counts, expected_hists = _per_medication_scores(eng, img, gray, medications)
+
+    assert scores['med_ids'].tolist() == [1, 2, 3, 4, 5, 6]
+    assert scores['match_counts'].tolist() == expected_counts.tolist()
+    assert expected_counts[0] > 0 and expected_counts[4] > 0
+    np.testing.assert_allclose(scores['histogram_scores'], expected_hists, atol=1e-5)
+
+
+def test_missing_histogram_scores_zero(scoring_setup):
+    eng, frame, _, _, medications = scoring_setup
+    references = eng.load_references(medications)
+    scores = eng.score_references(frame, references)
+
+    assert references['has_hist'].tolist() == [True, True, False, True, False, True]
+    assert scores['histogram_scores'][[2, 4]].tolist() == [0.0, 0.0]
+
+
+def test_load_references_does_not_pad(scoring_setup):
+    eng, _, _, _, medications = scoring_setup
+    references = eng.load_references(medications)
+    counts = np.diff(references['orb_offsets'])
+    assert len(references['orb']) == counts.sum()
+    assert counts[3] == 0
+
+
+# ---------------------------------------------------------------------------
+# Colour histograms
+# ---------------------------------------------------------------------------
+
+def _calc_hist_norm(hsv):
+    """The calcHist + normalize path the Numba kernel replaced"""
+    hist = cv2.calcHist([hsv], [0, 1], None, [vision_module.HIST_BINS_H, vision_module.HIST_BINS_S],
+                        [0, 180, 0, 256])
+    cv2.normalize(hist, hist, 0, 1, cv2.NORM_MINMAX)
+    return hist.flatten()
+
+
+def _hs_grid():
+    """One pixel for every (H, S) an 8-bit HSV image can hold"""
+    h, s = np.meshgrid(np.arange(180, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing='ij')
+    return np.ascontiguousarray(np.dstack([h, s, np.full_like(h, 128)]))
+
+
+@pytest.mark.parametrize('n_chunks', [1, 3, 8])
+def test_hs_hist_kernel_bin_edges(n_chunks):
+    pytest.importorskip('numba')
+    hsv = _hs_grid()
+    # A second copy of one column/row makes the counts uneven, so the
+    # normalized histogram isn't flat and the bin each edge lands in matters
+    hsv = np.ascontiguousarray(np.vstack([hsv, hsv[[0, 17, 18, 179]]]))
+    hist = vision_module._hs_hist_norm(hsv, n_chunks)
+    np.testing.assert_allclose(hist, _calc_hist_norm(hsv), atol=1e-6)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_hs_hist_kernel_matches_calc_hist(seed):
+    pytest.importorskip('numba')
+    img = _textured_frame(seed)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    expected = _calc_hist_norm(hsv)
+    np.testing.assert_allclose(vision_module._hs_hist_norm(hsv, 4), expected, atol=1e-6)
+    np.testing.assert_allclose(VisionEngineV2().compute_color_histogram(img), expected, atol=1e-6)
+
+
+def test_hs_hist_kernel_uniform_image():
+    pytest.importorskip('numba')
+    hsv = np.zeros((10, 10, 3), dtype=np.uint8)
+    hsv[:] = (90, 200, 50)
+    np.testing.assert_allclose(vision_module._hs_hist_norm(hsv, 2), _calc_hist_norm(hsv), atol=1e-6)
+
+
+def _compare_hist(h1, h2):
+    return cv2.compareHist(h1.reshape(-1, 1).astype(np.float32), h2.reshape(-1, 1).astype(np.float32),
+                           cv2.HISTCMP_CORREL)
+
+
+def test_compare_histograms_batch_matches_compare_hist():
+    rng = np.random.default_rng(5)
+    live = rng.random(vision_module.HIST_BINS_H * vision_module.HIST_BINS_S).astype(np.float32)
+    refs = np.vstack([
+        rng.random((4, live.size)),
+        live * 3 + 1,                               # perfectly correlated
+        1 - live,                                   # perfectly anti-correlated
+        np.rint(live * 255) / 255,                  # uint8-quantized fingerprint
+    ]).astype(np.float32)
+    eng = VisionEngineV2()
+
+    scores = eng.compare_histograms_batch(refs, live)
+    expected = [_compare_hist(ref, live) for ref in refs]
+    np.testing.assert_allclose(scores, expected, atol=1e-5)
+    np.testing.assert_allclose(scores, [eng.compare_histograms(ref, live) for ref in refs], atol=1e-5)
+
+
+def test_constant_histograms_never_match():
+    rng = np.random.default_rng(6)
+    live = rng.random(vision_module.HIST_BINS_H * vision_module.HIST_BINS_S).astype(np.float32)
+    refs = np.vstack([np.zeros_like(live), np.full_like(live, 0.5), live])
+    eng = VisionEngineV2()
+
+    scores = eng.compare_histograms_batch(refs, live)
+    assert scores[:2].tolist() == [0.0, 0.0]
+    assert scores[2] == pytest.approx(1.0)
+    assert eng.compare_histograms(refs[1], live) == 0.0
+    assert eng.compare_histograms_batch(refs[2:], np.zeros_like(live)).tolist() == [0.0]
+
+
+# ---------------------------------------------------------------------------
+# Frame decoding
+# ---------------------------------------------------------------------------
+
+def _with_orientation(jpeg: bytes, orientation: int, order: str = 'little') -> bytes:
+    """Insert an EXIF APP1 segment carrying only an orientation tag after SOI"""
+    mark = b'II' if order == 'little' else b'MM'
+    u16 = lambda v: v.to_bytes(2, order)
+    u32 = lambda v: v.to_bytes(4, order)
+    tiff = mark + u16(42) + u32(8) + u16(1) + u16(0x0112) + u16(3) + u32(1) + u16(orientation) + u16(0) + u32(0)
+    payload = b'Exif\x00\x00' + tiff
+    return jpeg[:2] + b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload + jpeg[2:]
+
+
+class _IgnoresOrientation:
+    """TurboJPEG stand-in: decodes the stored pixels, like libjpeg-turbo does"""
+
+    def decode(self, buf, pixel_format):
+        flags = cv2.IMREAD_IGNORE_ORIENTATION
+        if pixel_format == 'gray':
+            return cv2.imdecode(np.frombuffer(buf, np.uint8), flags | cv2.IMREAD_GRAYSCALE)[:, :, None]
+        return cv2.imdecode(np.frombuffer(buf, np.uint8), flags | cv2.IMREAD_COLOR)
+
+
+@pytest.mark.parametrize('order', ['little', 'big'])
+def test_exif_orientation(order):
+    ok, buf = cv2.imencode('.jpg', _textured_frame(0, size=(40, 60)))
+    jpeg = buf.tobytes()
+    assert vision_module._exif_orientation(jpeg) == 1
+    for orientation in (1, 3, 6, 8):
+        assert vision_module._exif_orientation(_with_orientation(jpeg, orientation, order)) == orientation
+
+
+@pytest.mark.parametrize('grayscale', [False, True])
+def test_decode_image_applies_exif_orientation(monkeypatch, grayscale):
+    monkeypatch.setattr(vision_module, '_turbo_jpeg', _IgnoresOrientation())
+    monkeypatch.setattr(vision_module, 'TJPF_BGR', 'bgr', raising=False)
+    monkeypatch.setattr(vision_module, 'TJPF_GRAY', 'gray', raising=False)
+    ok, buf = cv2.imencode('.jpg', _textured_frame(0, size=(40, 60)))
+    flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+
+    for orientation in (1, 6):
+        jpeg = _with_orientation(buf.tobytes(), orientation)
+        img = vision_module._decode_image(base64.b64encode(jpeg).decode('ascii'), grayscale=grayscale)
+        expected = cv2.imdecode(np.frombuffer(jpeg, np.uint8), flags)
+        assert img.shape == expected.shape
+        assert np.array_equal(img, expected)
+    assert img.shape[:2] == (60, 40)  # rotated a quarter turn